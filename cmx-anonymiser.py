@@ -11,7 +11,10 @@ try:
     from requests.packages.urllib3.exceptions import InsecureRequestWarning
     requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
     from requests.auth import HTTPBasicAuth
+    from requests.adapters import HTTPAdapter
     from collections import defaultdict
+    from collections import OrderedDict
+    from collections import deque
     import csv
     import hashlib
     from datetime import datetime
@@ -19,49 +22,364 @@ try:
     import os
     import sched, time
     from math import ceil
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+    import logging as stdlogging
+    from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+    import queue
+    import atexit
+    from contextlib import contextmanager
+    import pickle
+    import json
+    import io
+    import random
+    import gzip
+    from array import array
+    import signal
+    import re
+    from email.utils import parsedate_to_datetime
 except ImportError:
     print('Error: Missing one of the required modules. Check the docs.')
     sys.exit()
 
+# Optional faster JSON parsers, json from the standard library is used if they are missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+# Optional, used to work out the aggregate percentiles and totals a column at a time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+# Optional output formats, zstd compressed csv and Parquet
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 #Constants
 # CMX API URL prefix, could be changed to https://
 url_prefix = "http://"
 
+# The columns written for each client and AP and where they come from in the CMX JSON.
+# One column per line: name = dotted.path.into.record | default
+# Numbers in the path index into lists. A path starting with ~ has its value deidentified with
+# deidentifyMac. The default is used if the field is missing or null, an empty string if not given.
+# Both can be overridden with client_fields and ap_fields in the [projection] section of config.ini.
+default_client_fields = """
+hash = ~macAddress
+mapHierarchyString = mapInfo.mapHierarchyString
+floorRefId = mapInfo.floorRefId
+length = mapInfo.floorDimension.length
+width = mapInfo.floorDimension.width
+x = mapCoordinate.x
+y = mapCoordinate.y
+unit = mapCoordinate.unit
+currentlyTracked = currentlyTracked
+confidenceFactor = confidenceFactor
+currentServerTime = statistics.currentServerTime
+firstLocatedTime = statistics.firstLocatedTime
+lastLocatedTime = statistics.lastLocatedTime
+maxDetectedRssiApMacAddress = statistics.maxDetectedRssi.apMacAddress
+band = statistics.maxDetectedRssi.band
+rssi = statistics.maxDetectedRssi.rssi
+lastHeardInSeconds = statistics.maxDetectedRssi.lastHeardInSeconds
+networkStatus = networkStatus
+changedOn = changedOn
+ssId = ssId
+band = band
+apMacAddress = apMacAddress
+dot11Status = dot11Status
+manufacturer = manufacturer
+detectingControllers = detectingControllers
+bytesSent = bytesSent
+bytesReceived = bytesReceived
+"""
+default_ap_fields = """
+radioMacAddress = radioMacAddress
+name = name
+x = mapCoordinates.x
+y = mapCoordinates.y
+unit = mapCoordinates.unit
+802_11_BChannelNumber = apInterfaces.0.channelNumber | 0
+802_11_BTxPowerLevel = apInterfaces.0.txPowerLevel | 0
+802_11_AChannelNumber = apInterfaces.1.channelNumber | 0
+802_11_ATxPowerLevel = apInterfaces.1.txPowerLevel | 0
+floorId = floorIdString
+"""
+
+class Field:
+    # One projected column: its name, the path to it in the JSON record and the default
+    def __init__(self, name, path, default, deidentify):
+        self.name = name
+        self.path = path
+        self.default = default
+        self.deidentify = deidentify
+
+    def extract(self, record):
+        value = record
+        try:
+            for key in self.path:
+                value = value[key]
+        except (KeyError, IndexError, TypeError):
+            return self.default
+        if value is None:
+            return self.default
+        return value
+
+def parseFields(text):
+    # Turn the projection text into a list of Fields, raises ValueError if a line can't be understood
+    fields = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        name, sep, path = line.partition('=')
+        if not sep or not name.strip() or not path.strip():
+            raise ValueError('projection line should be name = path | default: {}'.format(line))
+        path, sep, default = path.partition('|')
+        path = path.strip()
+        deidentify = path.startswith('~')
+        path = path.lstrip('~')
+        default = default.strip()
+        # Keep numeric defaults as numbers so they are written the same as values from CMX
+        if default.lstrip('-').isdigit():
+            default = int(default)
+        keys = tuple(int(key) if key.isdigit() else key for key in path.split('.'))
+        fields.append(Field(name.strip(), keys, default, deidentify))
+    if not fields:
+        raise ValueError('projection has no fields')
+    return fields
+
+# Limits of each field in a cron expression: second minute hour day-of-month month day-of-week
+cron_limits = [(0, 59), (0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+def parseCronField(text, low, high):
+    # One cron field into the set of values it matches, e.g. */15, 1-5, 8,12,17 or 9-17/2
+    values = set()
+    for part in text.split(','):
+        part, sep, step = part.partition('/')
+        step = int(step) if sep else 1
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [int(value) for value in part.split('-', 1)]
+        else:
+            # 5/10 means from 5 to the end in steps of 10
+            start = int(part)
+            end = high if sep else start
+        if step < 1 or start < low or end > high or start > end:
+            raise ValueError('cron field {} should be within {}-{}'.format(text, low, high))
+        values.update(range(start, end+1, step))
+    return values
+
+class CronSchedule:
+    # A cron expression with an optional seconds field first, so 5 fields is the usual
+    # minute hour day-of-month month day-of-week and 6 fields allows runs more often than a minute.
+    # Like cron, when both day fields are restricted a day matching either one will do.
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) == 5:
+            fields.insert(0, '0')
+        if len(fields) != 6:
+            raise ValueError('cron expression should have 5 or 6 fields: {}'.format(expression))
+        self.seconds, self.minutes, self.hours, self.days, self.months, self.weekdays = \
+            [parseCronField(field, low, high) for field, (low, high) in zip(fields, cron_limits)]
+        # Sunday is both 0 and 7
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+        self.any_day = fields[3] == '*'
+        self.any_weekday = fields[5] == '*'
+        # Catch expressions like 0 0 30 2 * that can never run
+        self.next(datetime.now())
+
+    def dayMatches(self, when):
+        day = when.day in self.days
+        weekday = when.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next(self, after):
+        # The first matching second after after, skipping whole months, days, hours and minutes that can't match
+        when = after.replace(microsecond=0) + timedelta(seconds=1)
+        while when.year <= after.year + 5:
+            if when.month not in self.months:
+                when = datetime(when.year + when.month // 12, when.month % 12 + 1, 1)
+            elif not self.dayMatches(when):
+                when = datetime(when.year, when.month, when.day) + timedelta(days=1)
+            elif when.hour not in self.hours:
+                when = when.replace(minute=0, second=0) + timedelta(hours=1)
+            elif when.minute not in self.minutes:
+                when = when.replace(second=0) + timedelta(minutes=1)
+            elif when.second not in self.seconds:
+                when += timedelta(seconds=1)
+            else:
+                return when
+        raise ValueError('cron expression never runs')
+
+interval_units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+class IntervalSchedule:
+    # every 30s, every 5m, every 2h or every 1d. Runs are lined up on the clock so every 15m
+    # runs at :00, :15, :30 and :45 rather than 15 minutes after whenever the process started.
+    def __init__(self, expression):
+        match = re.fullmatch(r'every\s+(\d+(?:\.\d+)?)\s*([smhd]?)', expression.strip().lower())
+        if not match:
+            raise ValueError('interval should look like every 30s, every 5m or every 1h: {}'.format(expression))
+        self.interval = float(match.group(1)) * interval_units[match.group(2) or 's']
+        if self.interval <= 0:
+            raise ValueError('interval should be more than 0: {}'.format(expression))
+
+    def next(self, after):
+        timestamp = after.timestamp()
+        return datetime.fromtimestamp((timestamp // self.interval + 1) * self.interval)
+
+def parseSchedule(expression):
+    # Either an interval (every 30s) or a cron expression, raises ValueError if it can't be understood
+    if expression.lower().startswith('every'):
+        return IntervalSchedule(expression)
+    return CronSchedule(expression)
+
+def pageSizeSetting(value):
+    # CMX returns at most 1000 clients a page, anything else means the most it will give
+    value = int(value)
+    if value > 1000 or value <= 0:
+        return 1000
+    return value
+
+def atLeastOne(value):
+    return max(int(value), 1)
+
+# How each per-CMX setting is turned from text into a value, the same whether it comes from [cmx]
+# or is overridden in a [cmx:<name>] section, so an override can't get past a check the global has
+cmx_settings = {
+    'timeout': int,
+    'retry': int,
+    'retry_sleep': int,
+    'page_size': pageSizeSetting,
+    'max_pages': int,
+    'concurrency': atLeastOne,
+    'rate_limit': float,
+    'rate_burst': atLeastOne,
+    'backoff_max': int,
+    'breaker_threshold': int,
+    'min_page_size': atLeastOne,
+}
+
+def cmxSetting(section, option, fallback):
+    return cmx_settings[option](config.get(section, option, fallback=fallback))
+
 #Read configuration from config.ini file into global variables
 #Expects to find is in the same directory as the program file
 config = configparser.ConfigParser()
 if os.path.isfile("config.ini"):
     try:
         config.read("config.ini")
-        cmx = config.get('cmx', 'cmx_ip')
-        username = config.get('cmx', 'username')
-        password = config.get('cmx', 'password')
-        timeout = config.get('cmx', 'timeout', fallback=4)
-        timeout = int(timeout)
-        max_retries = config.get('cmx', 'retry', fallback=5)
-        max_retries = int(max_retries)
-        sleep_between_retries = config.get('cmx', 'retry_sleep', fallback=3)
-        sleep_between_retries = int(sleep_between_retries)
+        # Settings in [cmx] apply to every CMX unless its own section overrides them
+        cmx = config.get('cmx', 'cmx_ip', fallback=None)
+        username = config.get('cmx', 'username', fallback='')
+        password = config.get('cmx', 'password', fallback='')
+        timeout = cmxSetting('cmx', 'timeout', 4)
+        max_retries = cmxSetting('cmx', 'retry', 5)
+        sleep_between_retries = cmxSetting('cmx', 'retry_sleep', 3)
         url_clients = config.get('cmx', 'url_clients', fallback="/api/location/v1/clients/")
         url_aps = config.get('cmx', 'url_aps', fallback="/api/config/v1/aps/")
         url_client_count = config.get('cmx', 'url_client_count', fallback="/api/location/v2/clients/count")
-        page_size = config.get('cmx', 'page_size', fallback=1000)
-        page_size = int(page_size)
-        if page_size > 1000 or page_size <= 0:
-            page_size = 1000
-        max_pages = config.get('cmx', 'max_pages', fallback=1000)
-        max_pages = int(max_pages)
+        page_size = cmxSetting('cmx', 'page_size', 1000)
+        max_pages = cmxSetting('cmx', 'max_pages', 1000)
+        concurrency = cmxSetting('cmx', 'concurrency', 4)
+        rate_limit = cmxSetting('cmx', 'rate_limit', 0)
+        rate_burst = cmxSetting('cmx', 'rate_burst', 5)
+        backoff_max = cmxSetting('cmx', 'backoff_max', 60)
+        breaker_threshold = cmxSetting('cmx', 'breaker_threshold', 3)
+        adaptive_page_size = config.getboolean('cmx', 'adaptive_page_size', fallback=True)
+        min_page_size = cmxSetting('cmx', 'min_page_size', 100)
         output_dir = config.get('output', 'output_dir', fallback=os.path.join(os.getcwd(), 'output'))
         log_dir = config.get('output', 'log_dir', fallback=os.path.join(os.getcwd(), 'logs'))
         log_console = config.getboolean('output', 'log_console', fallback=False)
+        log_level = config.get('output', 'log_level', fallback='INFO').upper()
+        log_format = config.get('output', 'log_format', fallback='text').lower()
+        log_rotate = config.get('output', 'log_rotate', fallback='none').lower()
+        log_max_bytes = config.get('output', 'log_max_bytes', fallback=10485760)
+        log_max_bytes = int(log_max_bytes)
+        log_backups = config.get('output', 'log_backups', fallback=5)
+        log_backups = int(log_backups)
+        log_when = config.get('output', 'log_when', fallback='midnight')
+        streaming = config.getboolean('output', 'streaming', fallback=False)
+        output_format = config.get('output', 'format', fallback='csv').lower()
+        if output_format not in ('csv', 'gzip', 'zstd', 'parquet'):
+            raise ValueError('output format should be csv, gzip, zstd or parquet: {}'.format(output_format))
+        compression_level = config.get('output', 'compression_level', fallback=None)
+        compression_level = int(compression_level) if compression_level else None
+        parquet_row_group = config.get('output', 'parquet_row_group', fallback=100000)
+        parquet_row_group = max(int(parquet_row_group), 1)
+        output_layout = config.get('output', 'layout', fallback='flat').lower()
+        if output_layout not in ('flat', 'partitioned'):
+            raise ValueError('output layout should be flat or partitioned: {}'.format(output_layout))
+        state_dir = config.get('output', 'state_dir', fallback=os.path.join(os.getcwd(), 'state'))
+        encode_aps = config.getboolean('output', 'encode_aps', fallback=False)
+        ap_cache_ttl = config.get('aps', 'cache_ttl', fallback=86400)
+        ap_cache_ttl = int(ap_cache_ttl)
+        metrics_enabled = config.getboolean('metrics', 'enabled', fallback=True)
+        metrics_dir = config.get('metrics', 'metrics_dir', fallback=os.path.join(os.getcwd(), 'metrics'))
+        delta_enabled = config.getboolean('delta', 'enabled', fallback=False)
+        delta_full_every = config.get('delta', 'full_every', fallback=24)
+        delta_full_every = max(int(delta_full_every), 1)
+        checkpoint_enabled = config.getboolean('checkpoint', 'enabled', fallback=False)
+        checkpoint_retry_passes = config.get('checkpoint', 'retry_passes', fallback=1)
+        checkpoint_retry_passes = max(int(checkpoint_retry_passes), 0)
+        checkpoint_max_age = config.get('checkpoint', 'max_age', fallback=300)
+        checkpoint_max_age = int(checkpoint_max_age)
+        aggregate_enabled = config.getboolean('aggregate', 'enabled', fallback=False)
+        aggregate_group_by = list(dict.fromkeys(name.strip() for name in config.get('aggregate', 'group_by', fallback='mapHierarchyString,apMacAddress,band').split(',') if name.strip()))
+        aggregate_percentile_columns = list(dict.fromkeys(name.strip() for name in config.get('aggregate', 'percentile_columns', fallback='rssi,confidenceFactor').split(',') if name.strip()))
+        aggregate_sum_columns = list(dict.fromkeys(name.strip() for name in config.get('aggregate', 'sum_columns', fallback='bytesSent,bytesReceived').split(',') if name.strip()))
+        aggregate_percentiles = [float(value) for value in config.get('aggregate', 'percentiles', fallback='10,50,90').split(',') if value.strip()]
+        if any(value < 0 or value > 100 for value in aggregate_percentiles):
+            raise ValueError('aggregate percentiles should be between 0 and 100')
         days = config.get('schedule', 'days', fallback=5)
         days = int(days)
         schedule = config.get('schedule', 'hours', fallback='9:00,12:00,15:00,18:00')
+        schedule_expression = config.get('schedule', 'expression', fallback='').strip()
+        run_schedule = parseSchedule(schedule_expression) if schedule_expression else None
+        overlap = config.get('schedule', 'overlap', fallback='skip').lower()
+        if overlap not in ('skip', 'coalesce'):
+            raise ValueError('overlap should be skip or coalesce: {}'.format(overlap))
+        shutdown_grace = config.get('schedule', 'shutdown_grace', fallback=60)
+        shutdown_grace = max(int(shutdown_grace), 0)
         salt = config.get('privacy', 'salt', fallback='b1303114888c11e79e6a448500844918')
+        token_cache_size = config.get('privacy', 'cache_size', fallback=200000)
+        token_cache_size = int(token_cache_size)
+        json_backend = config.get('cmx', 'json_backend', fallback='auto').lower()
+        # Each CMX to poll is [cmx] if it has a cmx_ip, plus a [cmx:<name>] section for every other one
+        appliance_sections = [section for section in config.sections() if section.startswith('cmx:')]
+        if cmx is not None:
+            appliance_sections.insert(0, 'cmx')
+        if not appliance_sections:
+            raise configparser.NoOptionError('cmx_ip', 'cmx')
+        client_fields = parseFields(config.get('projection', 'client_fields', fallback=default_client_fields))
+        ap_fields = parseFields(config.get('projection', 'ap_fields', fallback=default_ap_fields))
+        # The delta index keys clients on their token, so it needs a de-identified column
+        if delta_enabled and not any(field.deidentify for field in client_fields):
+            raise ValueError('delta needs a de-identified (~) column in client_fields to key clients on')
         configError = False
     except configparser.Error as e:
         print("Error with config.ini, missing part of the file: ", e)
         configError = True
+    except ValueError as e:
+        print("Error with config.ini, bad value: ", e)
+        configError = True
 else:
     print("config.ini missing from current directory.")
     configError = True
@@ -76,285 +394,1790 @@ if not os.path.exists(log_dir):
 logFile = 'cmx' + datetime.strftime(datetime.now(),'-%d-%m-%y-%H-%M.log')
 fulllogFile = os.path.join(log_dir, logFile)
 
-def logging(info):
-    # Setup logging to a file and console
-    # Create a unique name with the date and time
-    dateStamp = datetime.strftime(datetime.now(),'%d/%m/%y %H:%M.%S.%f: ') + info
+class LogFormatter(stdlogging.Formatter):
+    # Same layout the log files have always had: date and time down to microseconds then the message
+    def format(self, record):
+        dateStamp = datetime.strftime(datetime.fromtimestamp(record.created),'%d/%m/%y %H:%M.%S.%f: ')
+        return dateStamp + record.getMessage()
+
+class JSONLogFormatter(stdlogging.Formatter):
+    # One JSON object per line so the logs can be loaded by log collectors
+    def format(self, record):
+        return json.dumps({'time': datetime.fromtimestamp(record.created).isoformat(),
+                           'level': record.levelname,
+                           'thread': record.threadName,
+                           'message': record.getMessage()})
+
+def setupLogging():
+    # Log records are put on a queue by the caller and written to the file and console by a
+    # background thread, so nothing in the fetch path waits on the disk.
+    if log_rotate == 'size':
+        fileHandler = RotatingFileHandler(fulllogFile, maxBytes=log_max_bytes, backupCount=log_backups, encoding='utf-8', delay=True)
+    elif log_rotate == 'time':
+        fileHandler = TimedRotatingFileHandler(fulllogFile, when=log_when, backupCount=log_backups, encoding='utf-8', delay=True)
+    else:
+        fileHandler = stdlogging.FileHandler(fulllogFile, encoding='utf-8', delay=True)
+    handlers = [fileHandler]
     if log_console:
-        print(dateStamp)
-    try:
-        with open(fulllogFile,'a', newline='\n', encoding='utf-8') as f:
-            print(dateStamp, file=f)
-    except OSError as e:
-        print('Error - tried to open file for writing but something went wront {}'.format(e))
+        handlers.append(stdlogging.StreamHandler(sys.stdout))
+    formatter = JSONLogFormatter() if log_format == 'json' else LogFormatter()
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    logger = stdlogging.getLogger('cmx-anonymiser')
+    logger.setLevel(getattr(stdlogging, log_level, stdlogging.INFO))
+    logger.addHandler(QueueHandler(log_queue))
+    logger.propagate = False
+    listener.start()
+    # Make sure everything on the queue gets written before the process exits
+    atexit.register(listener.stop)
+    return logger
+
+logger = setupLogging()
+
+def logging(info, level=stdlogging.INFO):
+    # Log to the file and console, level is one of the standard logging levels
+    logger.log(level, info)
     return
 
+# Set when the process is asked to stop. Waits between retries use it so a stopping
+# process isn't held up by a CMX that is backing us off.
+stop_event = threading.Event()
+
+class MacTokeniser:
+    # Turns mac-addresses into tokens. The token is sha256(salt + mac) exactly as it has always been,
+    # but the salt is only encoded and hashed once and the result copied for each mac. As most macs
+    # are seen again on the next poll the tokens are kept in a bounded least recently used cache.
+    def __init__(self, salt, cache_size):
+        self.salted = hashlib.sha256(salt.encode())
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def hash(self, mac):
+        mac_hashed = self.salted.copy()
+        mac_hashed.update(mac.encode())
+        return mac_hashed.hexdigest()
+
+    def remember(self, mac, token):
+        # Caller must hold the lock
+        if self.cache_size > 0:
+            self.cache[mac] = token
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def tokenise(self, mac):
+        with self.lock:
+            token = self.cache.get(mac)
+            if token is not None:
+                self.cache.move_to_end(mac)
+                self.hits += 1
+                return token
+            self.misses += 1
+        token = self.hash(mac)
+        with self.lock:
+            self.remember(mac, token)
+        return token
+
+    def tokeniseMany(self, macs):
+        # Tokenise a list of macs, returning the tokens in the same order. The cache is looked up
+        # and updated once for the whole list rather than taking the lock for every mac.
+        tokens = [None] * len(macs)
+        missing = defaultdict(list)
+        with self.lock:
+            for i, mac in enumerate(macs):
+                token = self.cache.get(mac)
+                if token is not None:
+                    self.cache.move_to_end(mac)
+                    self.hits += 1
+                    tokens[i] = token
+                else:
+                    missing[mac].append(i)
+            self.misses += len(missing)
+        if missing:
+            missing_macs = list(missing)
+            hashed = [self.hash(mac) for mac in missing_macs]
+            with self.lock:
+                for mac, token in zip(missing_macs, hashed):
+                    self.remember(mac, token)
+                    for i in missing[mac]:
+                        tokens[i] = token
+        return tokens
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.cache)}
+
+tokeniser = None
+tokeniser_lock = threading.Lock()
+
+def getTokeniser():
+    # The tokeniser is created on first use and then kept so its cache carries over between polls
+    global tokeniser
+    with tokeniser_lock:
+        if tokeniser is None:
+            tokeniser = MacTokeniser(salt, token_cache_size)
+    return tokeniser
+
 def deidentifyMac(mac):
     # Take the mac-address and deidentify it by securely hashing it
     # Add the salt to the mac and encode before hashing result and then returning the unique token
-    mac_hashed = hashlib.sha256(salt.encode()+mac.encode()).hexdigest()
-    return mac_hashed
+    return getTokeniser().tokenise(mac)
+
+class RunMetrics:
+    # Performance figures for one getData run: how long each stage took, a histogram of CMX request
+    # latencies, retries by failure type, bytes and rows per page and clients expected against received.
+    # Written at the end of the run as JSON and as a Prometheus textfile collector file.
+    latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+    def __init__(self, appliance_name):
+        self.appliance = appliance_name
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.latency_counts = [0] * (len(self.latency_buckets) + 1)
+        self.latency_sum = 0.0
+        self.requests = 0
+        self.retries = defaultdict(int)
+        self.response_bytes = 0
+        self.page_rows = {}
+        self.expected_clients = 0
+        self.received_clients = 0
+        self.success = False
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def observeRequest(self, seconds, response_bytes):
+        with self.lock:
+            self.requests += 1
+            self.latency_sum += seconds
+            self.response_bytes += response_bytes
+            for i, bucket in enumerate(self.latency_buckets):
+                if seconds <= bucket:
+                    self.latency_counts[i] += 1
+                    break
+            else:
+                self.latency_counts[-1] += 1
+
+    def observeRetry(self, reason):
+        with self.lock:
+            self.retries[reason] += 1
+
+    def observePage(self, page, rows):
+        with self.lock:
+            self.page_rows[page] = rows
+
+    def summary(self):
+        with self.lock:
+            return {'appliance': self.appliance,
+                    'started': datetime.fromtimestamp(self.started).isoformat(),
+                    'success': self.success,
+                    'stages_seconds': dict(self.stages),
+                    'requests': self.requests,
+                    'request_latency_buckets': dict(zip([str(b) for b in self.latency_buckets] + ['+Inf'], self.latency_counts)),
+                    'request_latency_sum_seconds': self.latency_sum,
+                    'retries': dict(self.retries),
+                    'response_bytes': self.response_bytes,
+                    'pages': len(self.page_rows),
+                    'rows_per_page': {str(page): rows for page, rows in sorted(self.page_rows.items())},
+                    'expected_clients': self.expected_clients,
+                    'received_clients': self.received_clients,
+                    'missing_clients': self.expected_clients - self.received_clients}
 
-def requestCMX(URL, response_dict):
+    def samples(self):
+        # (metric, labels, value) for the Prometheus file, every sample labelled with the appliance
+        summary = self.summary()
+        appliance = (('appliance', self.appliance),)
+        yield 'last_run_timestamp_seconds', appliance, self.started
+        yield 'last_run_success', appliance, int(self.success)
+        for name, seconds in summary['stages_seconds'].items():
+            yield 'stage_seconds', appliance + (('stage', name),), seconds
+        cumulative = 0
+        for le, count in summary['request_latency_buckets'].items():
+            cumulative += count
+            yield 'request_duration_seconds_bucket', appliance + (('le', le),), cumulative
+        yield 'request_duration_seconds_sum', appliance, summary['request_latency_sum_seconds']
+        yield 'request_duration_seconds_count', appliance, summary['requests']
+        for reason, count in summary['retries'].items():
+            yield 'retries', appliance + (('reason', reason),), count
+        yield 'response_bytes', appliance, summary['response_bytes']
+        yield 'pages', appliance, summary['pages']
+        yield 'clients_expected', appliance, summary['expected_clients']
+        yield 'clients_received', appliance, summary['received_clients']
+
+# Name, help and type of each metric in the Prometheus file, all values are for the last run
+prometheus_metrics = [('last_run_timestamp_seconds', 'When the last run started.', 'gauge'),
+                      ('last_run_success', '1 if the last run wrote its client data.', 'gauge'),
+                      ('stage_seconds', 'Seconds spent in each stage of the last run.', 'gauge'),
+                      ('request_duration_seconds', 'Latency of CMX API requests in the last run.', 'histogram'),
+                      ('retries', 'Retried CMX requests in the last run by failure type.', 'gauge'),
+                      ('response_bytes', 'Bytes received from CMX in the last run.', 'gauge'),
+                      ('pages', 'Client pages received in the last run.', 'gauge'),
+                      ('clients_expected', 'Client count reported by CMX in the last run.', 'gauge'),
+                      ('clients_received', 'Clients received from CMX in the last run.', 'gauge')]
+
+def prometheusText(run_metrics):
+    # Textfile collector format with the samples from every appliance under each metric
+    samples = [sample for metrics in run_metrics for sample in metrics.samples()]
+    lines = []
+    for name, help, type in prometheus_metrics:
+        lines.append('# HELP cmx_anonymiser_{} {}'.format(name, help))
+        lines.append('# TYPE cmx_anonymiser_{} {}'.format(name, type))
+        for sample, labels, value in samples:
+            if sample == name or (type == 'histogram' and sample.rsplit('_', 1)[0] == name):
+                labels = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+                lines.append('cmx_anonymiser_{}{{{}}} {}'.format(sample, labels, value))
+    return '\n'.join(lines) + '\n'
+
+def writeMetrics(appliances):
+    # Replace the files atomically so a collector never reads half of one
+    run_metrics = [appliance.metrics for appliance in appliances]
+    if not os.path.exists(metrics_dir):
+        os.makedirs(metrics_dir)
+    summary = {'appliances': {metrics.appliance: metrics.summary() for metrics in run_metrics}}
+    for fileName, text in [('cmx_metrics.json', json.dumps(summary, indent=2)),
+                           ('cmx_anonymiser.prom', prometheusText(run_metrics))]:
+        fullFileName = os.path.join(metrics_dir, fileName)
+        with open(fullFileName + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(fullFileName + '.tmp', fullFileName)
+
+class RateLimiter:
+    # Token bucket limiting requests to one CMX to rate per second with bursts of up to burst.
+    # When CMX throttles us (429/503) the rate is halved, and it creeps back up to the
+    # configured rate with every successful request. A rate of 0 means no limit.
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.current = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.current)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.current
+            if stop_event.wait(wait):
+                return
+
+    def throttle(self):
+        with self.lock:
+            if self.rate > 0:
+                self.current = max(self.rate / 16, self.current / 2)
+
+    def recover(self):
+        with self.lock:
+            if self.rate > 0:
+                self.current = min(self.rate, self.current + self.rate / 20)
+
+class CircuitBreaker:
+    # Opens after threshold requests in a row have failed every retry, after which requests
+    # to that CMX fail straight away for the rest of the run instead of piling onto a
+    # struggling appliance. reset() closes it again at the start of each run.
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def isOpen(self):
+        with self.lock:
+            return self.threshold > 0 and self.failures >= self.threshold
+
+    def recordFailure(self):
+        with self.lock:
+            self.failures += 1
+            return self.threshold > 0 and self.failures == self.threshold
+
+    def recordSuccess(self):
+        with self.lock:
+            if self.failures < self.threshold:
+                self.failures = 0
+
+    def reset(self):
+        with self.lock:
+            self.failures = 0
+
+def retryAfter(response):
+    # Seconds CMX asked us to wait in a Retry-After header, which is either seconds or a date
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(tz=parsedate_to_datetime(value).tzinfo)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+def backoffDelay(appliance, attempt, retry_after=None):
+    # Exponential backoff with full jitter so concurrent pages don't all retry together.
+    # If CMX said how long to wait we wait at least that long, up to backoff_max.
+    delay = random.uniform(0, min(appliance.backoff_max, appliance.sleep_between_retries * 2 ** (attempt - 1)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, appliance.backoff_max))
+    return delay
+
+class Appliance:
+    # One CMX to poll, with its own credentials, limits, keep-alive session, metrics and cached state.
+    # Settings missing from its config section are taken from [cmx]. The tag is added to output and
+    # state file names when more than one CMX is polled so their files don't collide.
+    def __init__(self, section, tagged):
+        def setting(option, fallback):
+            return config.get(section, option, fallback=fallback)
+        if ':' in section:
+            self.name = section.split(':', 1)[1]
+        else:
+            self.name = config.get('cmx', 'name', fallback='default')
+        self.tag = self.name if tagged else ''
+        self.host = setting('cmx_ip', None)
+        if not self.host:
+            raise configparser.NoOptionError('cmx_ip', section)
+        self.username = setting('username', username)
+        self.password = setting('password', password)
+        self.timeout = cmxSetting(section, 'timeout', timeout)
+        self.max_retries = cmxSetting(section, 'retry', max_retries)
+        self.sleep_between_retries = cmxSetting(section, 'retry_sleep', sleep_between_retries)
+        self.url_clients = setting('url_clients', url_clients)
+        self.url_aps = setting('url_aps', url_aps)
+        self.url_client_count = setting('url_client_count', url_client_count)
+        self.page_size = cmxSetting(section, 'page_size', page_size)
+        self.max_pages = cmxSetting(section, 'max_pages', max_pages)
+        self.concurrency = cmxSetting(section, 'concurrency', concurrency)
+        self.backoff_max = cmxSetting(section, 'backoff_max', backoff_max)
+        self.rateLimiter = RateLimiter(cmxSetting(section, 'rate_limit', rate_limit), cmxSetting(section, 'rate_burst', rate_burst))
+        self.breaker = CircuitBreaker(cmxSetting(section, 'breaker_threshold', breaker_threshold))
+        self.adaptive_page_size = config.getboolean(section, 'adaptive_page_size', fallback=adaptive_page_size)
+        self.min_page_size = cmxSetting(section, 'min_page_size', min_page_size)
+        # page_size is what the next run uses, it shrinks when pages keep timing out
+        self.configured_page_size = self.page_size
+        self.pages_split = 0
+        self.session = None
+        self.apCache = None
+        self.lock = threading.Lock()
+        # Metrics for the run in progress, replaced at the start of each run
+        self.metrics = RunMetrics(self.name)
+
+    def url(self, path):
+        return url_prefix + self.host + path
+
+    def adaptPageSize(self):
+        # After a run where pages had to be split use smaller pages from the start next time,
+        # and after a clean run grow back towards the configured page size
+        if not self.adaptive_page_size:
+            return
+        if self.pages_split > 0:
+            smaller = self.page_size // 2
+            if smaller >= self.min_page_size and self.page_size % 2 == 0:
+                self.page_size = smaller
+                logging('Appliance: {} pages timed out on {}, using a page size of {} from now on.'.format(self.pages_split, self.host, self.page_size), stdlogging.WARNING)
+        elif self.page_size < self.configured_page_size:
+            self.page_size = min(self.page_size * 2, self.configured_page_size)
+            logging('Appliance: No timeouts on {}, page size back up to {}.'.format(self.host, self.page_size))
+
+    def fileName(self, fileName):
+        # Add the tag to a file name when polling more than one CMX
+        if self.tag:
+            return fileName + '-' + self.tag
+        return fileName
+
+    def getSession(self):
+        # One keep-alive session shared by every request so TCP connections and basic auth are reused
+        # The connection pool is sized to the number of pages we fetch at the same time
+        with self.lock:
+            if self.session is None:
+                self.session = requests.Session()
+                self.session.auth = HTTPBasicAuth(self.username, self.password)
+                self.session.verify = False
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+                self.session.mount('http://', adapter)
+                self.session.mount('https://', adapter)
+        return self.session
+
+    def getAPCache(self):
+        # Created on first use and kept so the inventory and ids carry over between polls
+        with self.lock:
+            if self.apCache is None:
+                self.apCache = APCache(self)
+        return self.apCache
+
+def requestCMX(appliance, URL, response_dict, headers=None, splittable=False):
     # Generic API call to CMX with all the error handling
+    # headers can carry conditional request headers, in which case a 304 Not Modified is a good answer.
+    # Requests go through the appliance's rate limiter, failures are retried with jittered exponential
+    # backoff, and once the circuit breaker has opened the request fails without going to CMX.
+    # response_dict['isError'] is set if no good response was had, and the response is then None.
+    # response_dict['timedOut'] is set if the last failure was a timeout.
+    # splittable means the caller will fetch a page that timed out as two smaller pages, so the
+    # timeout isn't held against the circuit breaker unless those fail too.
     no_data = True
     number_retries = 1
-    response = requests.Session()
-    while no_data and number_retries <= max_retries:
-        logging("getData: Attempting to request data from cmx. Attempt number {}".format(number_retries))
+    response = None
+    metrics = appliance.metrics
+    response_dict['timedOut'] = False
+    if appliance.breaker.isOpen():
+        logging("requestCMX: Circuit breaker is open for {}, not requesting {}".format(appliance.host, URL), stdlogging.WARNING)
+        metrics.observeRetry('circuit_open')
+        response_dict['isError'] = True
+        return [None, response_dict]
+    while no_data and number_retries <= appliance.max_retries:
+        logging("getData: Attempting to request data from {}. Attempt number {}".format(appliance.host, number_retries))
+        wait_for = None
+        retryable = True
+        response_dict['timedOut'] = False
+        appliance.rateLimiter.acquire()
         try:
-            response = requests.get(url = URL, auth = HTTPBasicAuth(username, password), verify=False, timeout=timeout)
-            if response.status_code == 200:
+            start = time.perf_counter()
+            response = appliance.getSession().get(url = URL, timeout=appliance.timeout, headers=headers)
+            metrics.observeRequest(time.perf_counter() - start, len(response.content))
+            if response.status_code == 200 or (headers and response.status_code == 304):
                 no_data = False
                 response_dict['isError'] = False
+                appliance.rateLimiter.recover()
+            elif response.status_code in (429, 503):
+                # CMX is throttling us, slow down and wait as long as it asks
+                wait_for = retryAfter(response)
+                logging("getData: Got status code {} from CMX, throttled, Retry-After {}".format(response.status_code, wait_for), stdlogging.WARNING)
+                metrics.observeRetry('status_{}'.format(response.status_code))
+                appliance.rateLimiter.throttle()
+                response_dict['isError'] = True
+            elif response.status_code in (400, 401, 403, 404):
+                # Asking again won't change the answer
+                logging("getData: Got status code {} from CMX, not retrying".format(response.status_code), stdlogging.ERROR)
+                metrics.observeRetry('status_{}'.format(response.status_code))
+                response_dict['isError'] = True
+                retryable = False
             else:
-                logging("getData: Got status code {} from CMX, need 200, will retry".format(response.status_code))
+                logging("getData: Got status code {} from CMX, need 200, will retry".format(response.status_code), stdlogging.WARNING)
+                metrics.observeRetry('status_{}'.format(response.status_code))
                 response_dict['isError'] = True
-                # As number of retries increases the sleep time will increase to.
-                time.sleep(sleep_between_retries*number_retries)
-        except requests.exceptions.ConnectionError as e:
+        except requests.exceptions.Timeout as e:
             e = str(e)
-            logging("getData: Got connectError from URL requests\n"+e)
+            logging("getData: Got timeout from URL requests\n"+e, stdlogging.WARNING)
+            metrics.observeRetry('timeout')
             response_dict['isError'] = True
-            time.sleep(sleep_between_retries)
-        except requests.exceptions.HTTPError as e:
+            response_dict['timedOut'] = True
+        except requests.exceptions.ConnectionError as e:
             e = str(e)
-            logging("getData: Got HTTPError from URL requests\n"+e)
+            logging("getData: Got connectError from URL requests\n"+e, stdlogging.WARNING)
+            metrics.observeRetry('connection_error')
             response_dict['isError'] = True
-            time.sleep(sleep_between_retries)
-        except requests.exceptions.ConnectTimeout as e:
+        except requests.exceptions.HTTPError as e:
             e = str(e)
-            logging("getData: Got connectTimeout from URL requests\n"+e)
+            logging("getData: Got HTTPError from URL requests\n"+e, stdlogging.WARNING)
+            metrics.observeRetry('http_error')
             response_dict['isError'] = True
-            time.sleep(sleep_between_retries)
         except requests.exceptions.RequestException as e:
             e = str(e)
-            logging("getData: Got general error RequestException from URL requests\n"+e)
+            logging("getData: Got general error RequestException from URL requests\n"+e, stdlogging.WARNING)
+            metrics.observeRetry('request_exception')
             response_dict['isError'] = True
-            time.sleep(sleep_between_retries)
+        if no_data and (not retryable or number_retries == appliance.max_retries):
+            break
+        if no_data and stop_event.wait(backoffDelay(appliance, number_retries, wait_for)):
+            logging('requestCMX: Stopping, no more retries.', stdlogging.WARNING)
+            break
         number_retries += 1
     if no_data:
-        logging('getData: Something went wrong, no data returned.')
+        logging('getData: Something went wrong, no data returned.', stdlogging.ERROR)
+        response = None
+        # The smaller pages record their own failures if they fail as well
+        if not (splittable and response_dict['timedOut']) and appliance.breaker.recordFailure():
+            logging('requestCMX: {} requests in a row to {} failed, opening the circuit breaker for the rest of this run.'.format(appliance.breaker.threshold, appliance.host), stdlogging.ERROR)
+    else:
+        appliance.breaker.recordSuccess()
     return [response, response_dict]
 
-def getClientCount():
+def getClientCount(appliance):
     # API call to get the client count so we know how many pages to pull back
-    URL = url_prefix + cmx + url_client_count
+    # Returns None if CMX didn't give us a count
+    URL = appliance.url(appliance.url_client_count)
     logging('getClientCount: Getting client count for {}'.format(URL))
     # Setup a defaultdict so we can reference keys without errors
     response_dict = defaultdict(list)
-    response, response_dict = requestCMX(URL, response_dict)
+    response, response_dict = requestCMX(appliance, URL, response_dict)
     if not response_dict['isError']:
         # Step through the JSON response pulling out the data
-        client = response.json()
+        client = parseJSON(response.content)
         try:
             client_count = int(client['count'])
-        except ValueError as e:
-            logging('getClientCount: integer value not returned from client count'+e)
-            client_count = 0
-            pass  # it was a string, not an int.
+        except (ValueError, TypeError, KeyError) as e:
+            logging('getClientCount: integer value not returned from client count '+str(e), stdlogging.ERROR)
+            return None
         logging('getClientCount: Got client count of {:,}'.format(client_count))
     else:
-        logging('getClientCount: Got error response from API call for client count, setting count to zero')
-        client_count = 0
+        logging('getClientCount: Got error response from API call for client count', stdlogging.ERROR)
+        client_count = None
     return client_count
 
-def getCMXData():
+def parseJSON(content):
+    # Parse a whole JSON response body with the fastest parser we have
+    if orjson is not None and json_backend in ('auto', 'orjson'):
+        return orjson.loads(content)
+    return json.loads(content)
+
+def releasingIterator(records):
+    # Hand out each record and drop the list's reference to it, so a record is freed as soon
+    # as its row has been built and the page is never held twice
+    for i in range(len(records)):
+        record = records[i]
+        records[i] = None
+        yield record
+
+def parseRecords(content):
+    # Iterate over the records in a JSON list response. With the ijson backend the list is
+    # parsed incrementally so only one record is ever built at a time.
+    if ijson is not None and json_backend == 'ijson':
+        return ijson.items(io.BytesIO(content), 'item', use_float=True)
+    return releasingIterator(parseJSON(content))
+
+def projectRecord(record, fields):
+    # Build one row from a JSON record, missing or null fields get their default
+    return [field.extract(record) for field in fields]
+
+def buildRows(records, fields):
+    # Build the rows for a list of records, deidentifying the mac-address columns a page at a time
+    rows = [projectRecord(record, fields) for record in records]
+    for column, field in enumerate(fields):
+        if field.deidentify:
+            values = [row[column] for row in rows if row[column] != field.default]
+            tokens = iter(getTokeniser().tokeniseMany(values))
+            for row in rows:
+                if row[column] != field.default:
+                    row[column] = next(tokens)
+    return rows
+
+# Header for the client csv file
+client_header = [field.name for field in client_fields] if not configError else []
+
+def getCMXPage(appliance, page, page_size):
+    # Fetch one page of clients and turn it into rows. Runs in a worker thread so it
+    # gets its own response_dict rather than sharing one with the other pages.
+    suffix = '/?page={}&pageSize={}'.format(page, page_size)
+    URL = appliance.url(appliance.url_clients + suffix)
+    logging('getCMXPage: Getting data for {}'.format(URL))
+    page_dict = defaultdict(list)
+    splittable = appliance.adaptive_page_size and page_size % 2 == 0 and page_size // 2 >= appliance.min_page_size
+    response, page_dict = requestCMX(appliance, URL, page_dict, splittable=splittable)
+    if not page_dict['isError']:
+        # Check the status code of the result to see if we got something
+        logging('getCMXPage: Got status code {} for page {} from CMX API (200 is good)'.format(response.status_code, page))
+        page_dict['statusCode'] = response.status_code
+        if response.status_code == 200:
+            content = response.content
+            # Drop the response now we have its body
+            del response
+            # Step through the JSON response pulling out only the projected fields
+            rows = buildRows(parseRecords(content), client_fields)
+            del content
+            if encode_aps:
+                appliance.getAPCache().encodeRows(rows)
+            page_dict['data'] = rows
+    elif page_dict['timedOut'] and splittable:
+        # A big page keeps timing out, so get the same clients as two half size pages:
+        # page p of size n holds the same clients as pages 2p-1 and 2p of size n/2
+        half = page_size // 2
+        logging('getCMXPage: Page {} of {} timed out, getting it as pages {} and {} of {}.'.format(page, page_size, 2*page-1, 2*page, half), stdlogging.WARNING)
+        with appliance.lock:
+            appliance.pages_split += 1
+        first = getCMXPage(appliance, 2*page-1, half)
+        second = getCMXPage(appliance, 2*page, half)
+        if not first['isError'] and not second['isError']:
+            page_dict = defaultdict(list)
+            page_dict['isError'] = False
+            page_dict['statusCode'] = second['statusCode']
+            page_dict['data'] = first['data'] + second['data']
+    return page_dict
+
+class Checkpoint:
+    # Saves each page of client rows to state_dir as soon as it is fetched, with a state file
+    # listing the pages done and still missing. A page that fails every retry then only needs
+    # fetching again, straight away or by a later run, rather than the whole poll. The pages are
+    # saved after the mac-addresses are deidentified so nothing personal is written to disk.
+    def __init__(self, appliance):
+        self.directory = os.path.join(state_dir, appliance.fileName('checkpoint'))
+        self.stateFile = os.path.join(self.directory, 'state.json')
+        self.started = time.time()
+        self.page_size = None
+        self.pages = 0
+        self.done = {}
+        self.missing = set()
+        self.end = None
+        self.resuming = self.load()
+
+    def load(self):
+        # True if there is a recent enough unfinished poll to carry on with
+        try:
+            with open(self.stateFile, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logging('Checkpoint: Error - could not read {}, starting again {}'.format(self.stateFile, e), stdlogging.ERROR)
+            self.clear()
+            return False
+        age = time.time() - state['started']
+        if age > checkpoint_max_age:
+            logging('Checkpoint: Unfinished poll is {:.0f} secs old, more than max_age, starting again.'.format(age))
+            self.clear()
+            return False
+        self.started = state['started']
+        self.page_size = state['page_size']
+        self.pages = state['pages']
+        self.done = {int(page): rows for page, rows in state['done'].items()}
+        self.missing = set(state['missing'])
+        self.end = state['end']
+        return True
+
+    def start(self, page_size, pages):
+        self.page_size = page_size
+        self.pages = pages
+        self.save()
+
+    def save(self):
+        state = {'started': self.started, 'page_size': self.page_size, 'pages': self.pages,
+                 'done': self.done, 'missing': sorted(self.missing), 'end': self.end}
+        writeDurably(self.stateFile, json.dumps(state).encode('utf-8'))
+
+    def pageFile(self, page):
+        return os.path.join(self.directory, 'page-{:06d}.pickle'.format(page))
+
+    def savePage(self, page, rows):
+        writeDurably(self.pageFile(page), pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL))
+        self.done[page] = len(rows)
+        self.missing.discard(page)
+        self.save()
+
+    def missingPage(self, page):
+        self.missing.add(page)
+        self.save()
+
+    def lastPage(self, page):
+        # Pages after the last one have no clients, so there is no point asking for them again
+        self.end = page
+        self.missing = set(missing for missing in self.missing if missing < page)
+        self.save()
+
+    def loadPage(self, page):
+        with open(self.pageFile(page), 'rb') as f:
+            return pickle.load(f)
+
+    def newestRows(self, column):
+        # For each client token in column, the page and position of its most recently saved row.
+        # Pages from an earlier run can hold clients that have since moved to another page.
+        default = client_fields[column].default
+        saved = sorted(self.done, key=lambda page: (os.path.getmtime(self.pageFile(page)), page))
+        newest = {}
+        for page in saved:
+            for position, row in enumerate(self.loadPage(page)):
+                if row[column] and row[column] != default:
+                    newest[row[column]] = (page, position)
+        return newest
+
+    def clear(self):
+        # Called once the output has been committed
+        if os.path.isdir(self.directory):
+            for fileName in os.listdir(self.directory):
+                try:
+                    os.remove(os.path.join(self.directory, fileName))
+                except OSError as e:
+                    logging('Checkpoint: Error - could not remove {} {}'.format(fileName, e), stdlogging.ERROR)
+
+def writeDurably(fullFileName, data):
+    # Write a small file under a temporary name, fsync it and rename it into place
+    os.makedirs(os.path.dirname(fullFileName), exist_ok=True)
+    with open(fullFileName + '.tmp', 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(fullFileName + '.tmp', fullFileName)
+
+def getCMXData(appliance, output=None, checkpoint=None):
+    # If an output file is given each page is written to it as soon as it arrives and nothing
+    # is kept in response_dict['data'], so memory stays flat however many clients there are.
+    # With a checkpoint each page is saved to it instead, pages that failed are tried again, and
+    # the rows are only written out, in page order, once every page has been fetched.
     # Setup a defaultdict so we can reference keys without errors
     response_dict = defaultdict(list)
-    need_header = True
+    response_dict['isError'] = False
+    # How many pages of clients were fetched, none means there is nothing to compare with the last run
+    response_dict['pages'] = 0
+    records = 0
     # API call to get the client data from the CMX
-    client_count = getClientCount()
-    logging('getCMXData: Get client data for {:,} clients'.format(client_count))
-    if client_count <= 0:
+    client_count = getClientCount(appliance)
+    if client_count is None:
+        # Without a count we can't tell an empty CMX from a broken one, so the poll has failed
+        logging('getCMXData: Error - no client count from {}, not getting client data.'.format(appliance.host), stdlogging.ERROR)
+        response_dict['isError'] = True
+        appliance.metrics.observeRetry('count_error')
+        client_count = 0
+    elif client_count <= 0 and not (checkpoint is not None and checkpoint.resuming):
         logging('getCMXData: No clients so nothing to do.')
     else:
+        logging('getCMXData: Get client data for {:,} clients'.format(client_count))
         # Calculate the number of pages to get all the clients
+        page_size = appliance.page_size
+        max_pages = appliance.max_pages
+        concurrency = appliance.concurrency
         pages = ceil(client_count / page_size)
         if pages > max_pages:
             logging('getCMXData: Calculated pages {} > than max pages {}. Will set limit to max pages.'.format(pages, max_pages))
         # Ensure we don't get too many pages
         pages = min(pages, max_pages)
-        logging('getCMXData: Calculated {} pages to retrieve.'.format(pages))
-        for page in range(1,pages+1):
-            suffix = '/?page={}&pageSize={}'.format(page, page_size)
-            URL = url_prefix + cmx + url_clients + suffix
-            logging('getCMXData: Getting data for {}'.format(URL))
-            response, response_dict = requestCMX(URL, response_dict)
-            if not response_dict['isError']:
-                # Check the status code of the result to see if we got something
-                logging('getCMXData: Got status code {} from CMX API (200 is good)'.format(response.status_code))
-                response_dict['statusCode'] = response.status_code
-                if response.status_code == 200:
-                    response.encoding = 'utf-8'
-                    if need_header:
-                        need_header = False
-                        # Add a header for all the variables
-                        response_dict['data'].append(['hash',
-                                                     'mapHierarchyString',
-                                                      'floorRefId',
-                                                      'length',
-                                                      'width',
-                                                      'x',
-                                                      'y',
-                                                      'unit',
-                                                      'currentlyTracked',
-                                                      'confidenceFactor',
-                                                      'currentServerTime',
-                                                      'firstLocatedTime',
-                                                      'lastLocatedTime',
-                                                      'maxDetectedRssiApMacAddress',
-                                                      'band',
-                                                      'rssi',
-                                                      'lastHeardInSeconds',
-                                                      'networkStatus',
-                                                      'changedOn',
-                                                      'ssId',
-                                                      'band',
-                                                      'apMacAddress',
-                                                      'dot11Status',
-                                                      'manufacturer',
-                                                      'detectingControllers',
-                                                      'bytesSent',
-                                                      'bytesReceived'
-                                                     ])
-                    # Step through the JSON response pulling out the data
-                    for client in response.json():
-                        response_dict['data'].append([deidentifyMac(client['macAddress']), \
-                                                      client['mapInfo']['mapHierarchyString'], \
-                                                      client['mapInfo']['floorRefId'], \
-                                                      client['mapInfo']['floorDimension']['length'], \
-                                                      client['mapInfo']['floorDimension']['width'], \
-                                                      client['mapCoordinate']['x'], \
-                                                      client['mapCoordinate']['y'], \
-                                                      client['mapCoordinate']['unit'], \
-                                                      client['currentlyTracked'], \
-                                                      client['confidenceFactor'], \
-                                                      client['statistics']['currentServerTime'], \
-                                                      client['statistics']['firstLocatedTime'], \
-                                                      client['statistics']['lastLocatedTime'], \
-                                                      client['statistics']['maxDetectedRssi']['apMacAddress'], \
-                                                      client['statistics']['maxDetectedRssi']['band'], \
-                                                      client['statistics']['maxDetectedRssi']['rssi'], \
-                                                      client['statistics']['maxDetectedRssi']['lastHeardInSeconds'], \
-                                                      client['networkStatus'], \
-                                                      client['changedOn'], \
-                                                      client['ssId'], \
-                                                      client['band'], \
-                                                      client['apMacAddress'], \
-                                                      client['dot11Status'], \
-                                                      client['manufacturer'], \
-                                                      client['detectingControllers'], \
-                                                      client['bytesSent'], \
-                                                      client['bytesReceived']
-                                                     ])
-                    # We minus 1 due to header that was added to file
-            logging('getCMXData: Got {:,} total records from CMX, expecting {:,} clients'.format(len(response_dict['data'])-1, client_count))
+        if checkpoint is not None and checkpoint.resuming:
+            # Carry on with the unfinished poll, its page size decides which clients are on each page
+            page_size = checkpoint.page_size
+            pages = checkpoint.pages
+            logging('getCMXData: Resuming the poll from {}, {} pages saved and {} missing.'.format(
+                datetime.fromtimestamp(checkpoint.started), len(checkpoint.done), len(checkpoint.missing)))
+        elif checkpoint is not None:
+            checkpoint.start(page_size, pages)
+        logging('getCMXData: Calculated {} pages to retrieve from {}, {} at a time.'.format(pages, appliance.host, concurrency))
+        # Add a header for all the variables
+        if output is not None:
+            output.writerow(getClientHeader())
+        else:
+            response_dict['data'].append(getClientHeader())
+
+        def keepPage(page, rows):
+            # Where each page's rows go as they arrive
+            response_dict['pages'] += 1
+            if checkpoint is not None:
+                checkpoint.savePage(page, rows)
+            elif output is not None:
+                output.writerows(rows)
+            else:
+                response_dict['data'].extend(rows)
+
+        # A resumed poll that already found its last page only needs the missing pages
+        resumed_to_end = checkpoint is not None and checkpoint.end is not None
+        last_page = resumed_to_end
+        # Whether the last page consumed came back full, only then is it worth probing past the count
+        previous_full = True
+        probe_failed = False
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # Keep concurrency pages in flight, submitting the next page as each one completes so one
+            # slow page doesn't hold up the rest. Results are taken from the front of in_flight so
+            # they are still consumed in page order.
+            in_flight = deque()
+            fetching = 0
+            next_page = 1
+            while True:
+                while not last_page and next_page <= max_pages and fetching < concurrency:
+                    if checkpoint is not None and next_page in checkpoint.done:
+                        # Pages saved by an earlier run were full, or the poll would already know its last page
+                        in_flight.append((next_page, None))
+                    elif next_page <= pages or (not in_flight and previous_full):
+                        in_flight.append((next_page, executor.submit(getCMXPage, appliance, next_page, page_size)))
+                        fetching += 1
+                    elif not in_flight:
+                        logging('getCMXData: Page {} failed, not probing past the {} calculated pages.'.format(next_page - 1, pages), stdlogging.WARNING)
+                        break
+                    else:
+                        # Past the calculated page count the client count was wrong, so only probe one page
+                        # at a time until we get a short page, and stop probing as soon as a page fails so a
+                        # CMX that has gone away isn't asked up to max_pages.
+                        break
+                    next_page += 1
+                if not in_flight:
+                    break
+                page, future = in_flight.popleft()
+                if future is None:
+                    previous_full = True
+                    continue
+                fetching -= 1
+                page_dict = future.result()
+                if page_dict['isError']:
+                    logging('getCMXData: Error getting page {}, data will be incomplete.'.format(page), stdlogging.ERROR)
+                    response_dict['isError'] = True
+                    previous_full = False
+                    # A failed probe past the count isn't missing, the next run probes from there again
+                    if page > pages:
+                        probe_failed = True
+                    elif checkpoint is not None:
+                        checkpoint.missingPage(page)
+                    continue
+                response_dict['statusCode'] = page_dict['statusCode']
+                page_records = len(page_dict['data'])
+                records += page_records
+                appliance.metrics.observePage(page, page_records)
+                keepPage(page, page_dict['data'])
+                previous_full = True
+                # A short or empty page means we have reached the end of the clients
+                if page_records < page_size:
+                    logging('getCMXData: Page {} returned {} clients, that is the last page.'.format(page, page_records))
+                    last_page = True
+                    if checkpoint is not None:
+                        checkpoint.lastPage(page)
+                    # Pages after the last one are not needed, cancel the ones that haven't started
+                    for _, future in in_flight:
+                        if future is not None:
+                            future.cancel()
+                    break
+
+            if checkpoint is not None:
+                # Try the pages that failed again now, the pages around them are already saved.
+                # A resumed poll that skipped the loop above always gets one pass for its missing pages.
+                passes = checkpoint_retry_passes
+                if resumed_to_end:
+                    passes += 1
+                for retry_pass in range(passes):
+                    missing = sorted(checkpoint.missing)
+                    if not missing or stop_event.is_set() or appliance.breaker.isOpen():
+                        break
+                    logging('getCMXData: Trying the {} missing pages again: {}'.format(len(missing), missing))
+                    for page, page_dict in zip(missing, executor.map(lambda page: getCMXPage(appliance, page, page_size), missing)):
+                        if not page_dict['isError']:
+                            response_dict['statusCode'] = page_dict['statusCode']
+                            records += len(page_dict['data'])
+                            appliance.metrics.observePage(page, len(page_dict['data']))
+                            checkpoint.savePage(page, page_dict['data'])
+                if checkpoint.missing:
+                    logging('getCMXData: Error - pages {} are still missing, the saved pages are kept for the next run.'.format(sorted(checkpoint.missing)), stdlogging.ERROR)
+                    response_dict['isError'] = True
+                elif probe_failed:
+                    logging('getCMXData: Error - a page past the {} calculated pages failed before the last page was found, the saved pages are kept for the next run.'.format(pages), stdlogging.ERROR)
+                else:
+                    # Every page is saved, so write them all out in page order
+                    response_dict['isError'] = False
+                    response_dict['pages'] = len(checkpoint.done)
+                    records = 0
+                    duplicates = 0
+                    # A client saved in more than one page only keeps its newest row
+                    column = clientKeyColumn()
+                    newest = checkpoint.newestRows(column) if column is not None else None
+                    for page in sorted(checkpoint.done):
+                        rows = checkpoint.loadPage(page)
+                        if newest is not None:
+                            kept = [row for position, row in enumerate(rows) if newest.get(row[column], (page, position)) == (page, position)]
+                            duplicates += len(rows) - len(kept)
+                            rows = kept
+                        records += len(rows)
+                        if output is not None:
+                            output.writerows(rows)
+                        else:
+                            response_dict['data'].extend(rows)
+                    if duplicates:
+                        logging('getCMXData: Left out {} clients saved in more than one page, keeping their newest row.'.format(duplicates), stdlogging.WARNING)
+        logging('getCMXData: Got {:,} total records from CMX, expecting {:,} clients'.format(records, client_count))
+    appliance.metrics.expected_clients = client_count
+    appliance.metrics.received_clients = records
 
     return response_dict
 
-def getCMXAPData():
-    # Get the AP data from the CMX
-    URL = url_prefix + cmx + url_aps
-    logging('getCMXAPData: Getting data for API: {}'.format(URL))
+# Header for the ap csv file
+ap_header = [field.name for field in ap_fields] if not configError else []
+
+class APCache:
+    # Keeps the AP inventory between runs in state_dir so it is only downloaded again once cache_ttl
+    # has passed, and then with If-None-Match/If-Modified-Since so CMX can answer 304 if nothing changed.
+    # Also holds the dictionaries that give each AP mac-address and mapHierarchyString a small integer
+    # id, used when encode_aps is set to replace those long strings in the client rows.
+    def __init__(self, appliance):
+        self.cacheFile = os.path.join(state_dir, appliance.fileName('ap_cache') + '.json')
+        self.fetched = 0
+        self.etag = None
+        self.lastModified = None
+        self.data = []
+        self.apIds = {}
+        self.floorIds = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        # Client columns that are replaced by ids and which dictionary they use
+        self.encodeColumns = [(client_header.index(name), self.apIds) for name in ['maxDetectedRssiApMacAddress', 'apMacAddress'] if name in client_header] + \
+                             [(client_header.index(name), self.floorIds) for name in ['mapHierarchyString'] if name in client_header]
+        self.load()
+
+    def load(self):
+        if os.path.isfile(self.cacheFile):
+            try:
+                with open(self.cacheFile, 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+                self.fetched = cache['fetched']
+                self.etag = cache['etag']
+                self.lastModified = cache['lastModified']
+                self.data = cache['data']
+                self.apIds.update(cache['apIds'])
+                self.floorIds.update(cache['floorIds'])
+                logging('APCache: Loaded {:,} aps from {}'.format(len(self.data), self.cacheFile))
+            except (OSError, ValueError, KeyError) as e:
+                logging('APCache: Error - could not load {}, will download the aps again {}'.format(self.cacheFile, e), stdlogging.ERROR)
+                self.fetched = 0
+                self.data = []
+
+    def save(self):
+        with self.lock:
+            cache = {'fetched': self.fetched,
+                     'etag': self.etag,
+                     'lastModified': self.lastModified,
+                     'data': self.data,
+                     'apIds': self.apIds,
+                     'floorIds': self.floorIds}
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+        tempFile = self.cacheFile + '.tmp'
+        with open(tempFile, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        os.replace(tempFile, self.cacheFile)
+
+    def age(self):
+        return time.time() - self.fetched
+
+    def fresh(self):
+        return len(self.data) > 0 and self.age() < ap_cache_ttl
+
+    def conditionalHeaders(self):
+        headers = {}
+        if self.data:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.lastModified:
+                headers['If-Modified-Since'] = self.lastModified
+        return headers
+
+    def touch(self):
+        # CMX told us nothing has changed, start the TTL again
+        self.fetched = time.time()
+        self.save()
+
+    def update(self, data, response):
+        # Store a freshly downloaded inventory, returns True if it differs from what we had.
+        # Compare through json so cached rows loaded from disk match the new ones.
+        changed = json.loads(json.dumps(data)) != self.data
+        with self.lock:
+            self.data = json.loads(json.dumps(data))
+            self.etag = response.headers.get('ETag')
+            self.lastModified = response.headers.get('Last-Modified')
+            self.fetched = time.time()
+            for row in self.data[1:]:
+                self.getId(self.apIds, row[0])
+        self.save()
+        return changed
+
+    def getId(self, ids, value):
+        # Caller must hold the lock. New values get the next id so existing ids never change.
+        id = ids.get(value)
+        if id is None:
+            id = len(ids)
+            ids[value] = id
+            self.dirty = True
+        return id
+
+    def apTable(self):
+        # The AP rows to write out, with their ids in front when encoding
+        if not encode_aps:
+            return self.data
+        with self.lock:
+            return [['apId'] + self.data[0]] + [[self.getId(self.apIds, row[0])] + row for row in self.data[1:]]
+
+    def encodeRows(self, rows):
+        # Swap the AP mac-addresses and mapHierarchyString in client rows for their ids
+        with self.lock:
+            for row in rows:
+                for column, ids in self.encodeColumns:
+                    row[column] = self.getId(ids, row[column])
+        return rows
+
+    def dictionaries(self):
+        # The id dictionaries to write out, this clears the dirty flag
+        with self.lock:
+            self.dirty = False
+            ap_dictionary = [['apId', 'apMacAddress']] + [[id, mac] for mac, id in self.apIds.items()]
+            floor_dictionary = [['mapHierarchyStringId', 'mapHierarchyString']] + [[id, name] for name, id in self.floorIds.items()]
+        return ap_dictionary, floor_dictionary
+
+# Client columns that encode_aps replaces with ids, they get an Id suffix
+encoded_ap_columns = ['maxDetectedRssiApMacAddress', 'apMacAddress', 'mapHierarchyString']
+
+def getClientHeader():
+    # The header for the client csv, which changes if the AP columns are encoded
+    if encode_aps:
+        return [name + 'Id' if name in encoded_ap_columns else name for name in client_header]
+    return client_header
+
+def getCMXAPData(appliance):
+    # Get the AP data from the CMX, or from the cache if it is still fresh.
+    # response_dict['changed'] says whether the inventory is different to the last one we wrote.
     response_dict = defaultdict(list)
-    response, response_dict = requestCMX(URL, response_dict)
+    cache = appliance.getAPCache()
+    if cache.fresh():
+        logging('getCMXAPData: Using AP inventory cached {:.0f} secs ago, cache_ttl is {} secs.'.format(cache.age(), ap_cache_ttl))
+        response_dict['isError'] = False
+        response_dict['changed'] = False
+        response_dict['data'] = cache.apTable()
+        return response_dict
+    URL = appliance.url(appliance.url_aps)
+    logging('getCMXAPData: Getting data for API: {}'.format(URL))
+    response, response_dict = requestCMX(appliance, URL, response_dict, cache.conditionalHeaders())
     if not response_dict['isError']:
         logging('getCMXAPData: Got status code {} from CMX API (200 is good)'.format(response.status_code))
         response_dict['statusCode'] = response.status_code
-        if response.status_code == 200:
-            response.encoding = 'utf-8'
-            response_dict['data'].append(['radioMacAddress',
-                                          'name',
-                                          'x',
-                                          'y',
-                                          'unit',
-                                          '802_11_BChannelNumber',
-                                          '802_11_BTxPowerLevel',
-                                          '802_11_AChannelNumber',
-                                          '802_11_ATxPowerLevel',
-                                          'floorId'
-                                         ])
-            for ap in response.json():
-                if len(ap['apInterfaces']) == 2:
-                    response_dict['data'].append([ap['radioMacAddress'], \
-                                                  ap['name'], \
-                                                  ap['mapCoordinates']['x'], \
-                                                  ap['mapCoordinates']['y'], \
-                                                  ap['mapCoordinates']['unit'], \
-                                                  ap['apInterfaces'][0]['channelNumber'], \
-                                                  ap['apInterfaces'][0]['txPowerLevel'], \
-                                                  ap['apInterfaces'][1]['channelNumber'], \
-                                                  ap['apInterfaces'][1]['txPowerLevel'], \
-                                                  ap['floorIdString']
-                                                 ])
-                elif len(ap['apInterfaces']) == 1:
-                    response_dict['data'].append([ap['radioMacAddress'], \
-                          ap['name'], \
-                          ap['mapCoordinates']['x'], \
-                          ap['mapCoordinates']['y'], \
-                          ap['mapCoordinates']['unit'], \
-                          ap['apInterfaces'][0]['channelNumber'], \
-                          ap['apInterfaces'][0]['txPowerLevel'], \
-                          0, \
-                          0, \
-                          ap['floorIdString']
-                         ])
-            logging('getCMXAPData: Got {:,} ap records from CMX.'.format(len(response_dict['data'])-1))
+        if response.status_code == 304:
+            logging('getCMXAPData: CMX says the AP inventory has not changed.')
+            cache.touch()
+            response_dict['changed'] = False
+        elif response.status_code == 200:
+            # Skip anything that isn't a placed AP with at least one radio
+            aps = [ap for ap in parseJSON(response.content) if isinstance(ap, dict) and ap.get('apInterfaces')]
+            data = [ap_header] + buildRows(aps, ap_fields)
+            logging('getCMXAPData: Got {:,} ap records from CMX.'.format(len(data)-1))
+            response_dict['changed'] = cache.update(data, response)
+        response_dict['data'] = cache.apTable()
 
     return response_dict
 
-def writeFile(data, fileName):
-    # Write the data to an appropriate file
-    logging('writeFile: Using {} as output directory'.format(os.path.abspath(output_dir)))
-    if not os.path.exists(output_dir):
+class OutputFile:
+    # A csv file in output_dir that is written under a temporary name and only renamed into
+    # place by commit(), so anything reading the output directory never sees a half written file.
+    # The other output formats are subclasses that change how the rows are encoded.
+    extension = '.csv'
+    format = 'csv'
+
+    def __init__(self, fullFileName, manifest=None):
+        self.fullFileName = fullFileName
+        self.tempFileName = fullFileName + '.tmp'
+        self.manifest = manifest
+        self.rows = 0
+        self.header = None
+        self.raw = open(self.tempFileName, 'wb')
+        self.open()
+
+    def open(self):
+        self.f = io.TextIOWrapper(self.raw, encoding='utf-8', newline='')
+        self.writer = csv.writer(self.f)
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def writerows(self, rows):
+        if self.header is None and rows:
+            self.header = list(rows[0])
+        self.writer.writerows(rows)
+        self.rows += len(rows)
+
+    def finish(self):
+        # Write anything still buffered through to the raw file, without closing it
+        self.f.flush()
+        self.f.detach()
+
+    def commit(self):
+        # Flush everything to disk before the rename so the final name always has complete data
+        self.finish()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+        os.replace(self.tempFileName, self.fullFileName)
+        logging('OutputFile: Committed {:,} rows to {}'.format(self.rows, self.fullFileName))
+        if self.manifest is not None:
+            updateManifest(self)
+
+    def abort(self):
+        self.raw.close()
+        try:
+            os.remove(self.tempFileName)
+        except OSError as e:
+            logging('OutputFile: Error - could not remove temporary file {} {}'.format(self.tempFileName, e), stdlogging.ERROR)
+        logging('OutputFile: Discarded {}'.format(self.tempFileName))
+
+class GzipOutputFile(OutputFile):
+    extension = '.csv.gz'
+    format = 'gzip'
+
+    def open(self):
+        # Name the file inside the gzip after the final file rather than the temporary one
+        self.stream = gzip.GzipFile(filename=os.path.basename(self.fullFileName)[:-3], mode='wb', fileobj=self.raw,
+                                    compresslevel=compression_level if compression_level is not None else 6)
+        self.f = io.TextIOWrapper(self.stream, encoding='utf-8', newline='')
+        self.writer = csv.writer(self.f)
+
+    def finish(self):
+        self.f.flush()
+        self.f.detach()
+        # Closing the GzipFile writes the trailer but leaves the raw file open
+        self.stream.close()
+
+class ZstdOutputFile(GzipOutputFile):
+    extension = '.csv.zst'
+    format = 'zstd'
+
+    def open(self):
+        compressor = zstandard.ZstdCompressor(level=compression_level if compression_level is not None else 3)
+        self.stream = compressor.stream_writer(self.raw, closefd=False)
+        self.f = io.TextIOWrapper(self.stream, encoding='utf-8', newline='')
+        self.writer = csv.writer(self.f)
+
+class ParquetOutputFile(OutputFile):
+    # Typed columns, so tools can read just the columns they want. Rows are buffered and written a
+    # row group at a time. The column types are worked out from the first row group: bool, double
+    # or string, with the empty string default written as null in the typed columns. Numbers are
+    # always double, as a column like x or y can hold only whole numbers in the first row group
+    # and fractions after it. A later value of another type, like a string in a double column,
+    # is written as null rather than changed to fit, and logged once for the column.
+    extension = '.parquet'
+    format = 'parquet'
+
+    def open(self):
+        self.batch = []
+        self.schema = None
+        self.writer = None
+        self.mismatched = set()
+
+    def writerows(self, rows):
+        if self.header is None and rows:
+            self.header = list(rows[0])
+            rows = rows[1:]
+            self.rows += 1
+        self.batch.extend(rows)
+        self.rows += len(rows)
+        if len(self.batch) >= parquet_row_group:
+            self.writeBatch()
+
+    def columnType(self, values):
+        values = [value for value in values if value is not None and value != '']
+        if not values:
+            return pyarrow.string()
+        if all(isinstance(value, bool) for value in values):
+            return pyarrow.bool_()
+        if all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+            return pyarrow.float64()
+        return pyarrow.string()
+
+    def columnArray(self, values, field):
+        kind = field.type
+        if kind == pyarrow.string():
+            return pyarrow.array([None if value is None else str(value) for value in values], kind)
+        # Only values already of the column's type are kept, an int will do for a double column
+        if kind == pyarrow.bool_():
+            fits = lambda value: isinstance(value, bool)
+        else:
+            fits = lambda value: isinstance(value, (int, float)) and not isinstance(value, bool)
+        converted = [value if fits(value) else None for value in values]
+        mismatched = sum(1 for value in values if value is not None and value != '' and not fits(value))
+        if mismatched and field.name not in self.mismatched:
+            self.mismatched.add(field.name)
+            logging('ParquetOutputFile: {} values in column {} are not {}, writing them as null.'.format(mismatched, field.name, kind), stdlogging.WARNING)
+        return pyarrow.array(converted, kind)
+
+    def writeBatch(self):
+        columns = list(zip(*self.batch)) if self.batch else [() for name in self.header]
+        if self.schema is None:
+            # Parquet readers look columns up by name, so a repeated name like band gets a number on the end
+            names = []
+            for position, name in enumerate(self.header):
+                count = self.header[:position].count(name)
+                names.append('{}_{}'.format(name, count + 1) if count else name)
+            self.schema = pyarrow.schema([(name, self.columnType(values)) for name, values in zip(names, columns)])
+            self.writer = pyarrow.parquet.ParquetWriter(self.raw, self.schema)
+        arrays = [self.columnArray(values, field) for values, field in zip(columns, self.schema)]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        self.batch = []
+
+    def finish(self):
+        if self.header is None:
+            self.header = []
+        if self.batch or self.writer is None:
+            self.writeBatch()
+        self.writer.close()
+
+    def abort(self):
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except (OSError, ValueError, pyarrow.ArrowException):
+                pass
+        OutputFile.abort(self)
+
+# The writer for each output format, and the module it needs
+output_writers = {'csv': (OutputFile, True),
+                  'gzip': (GzipOutputFile, True),
+                  'zstd': (ZstdOutputFile, zstandard is not None),
+                  'parquet': (ParquetOutputFile, pyarrow is not None)}
+
+def getOutputWriter():
+    # The writer for the configured format, gzip if the module for it isn't installed
+    writer, available = output_writers[output_format]
+    if not available:
+        logging('getOutputWriter: Error - {} output needs {} installed, writing gzip csv instead.'.format(
+            output_format, 'zstandard' if output_format == 'zstd' else 'pyarrow'), stdlogging.ERROR)
+        writer = GzipOutputFile
+    return writer
+
+manifest_lock = threading.Lock()
+
+def updateManifest(output):
+    # Add a committed file to its partition's _manifest.json, so a reader can see what a
+    # partition holds without opening the files. Replaced atomically like the files themselves.
+    entry = {'file': os.path.basename(output.fullFileName),
+             'kind': output.manifest,
+             'format': output.format,
+             'rows': max(output.rows - 1, 0),
+             'bytes': os.path.getsize(output.fullFileName),
+             'columns': output.header or [],
+             'written': datetime.now().isoformat()}
+    manifestFile = os.path.join(os.path.dirname(output.fullFileName), '_manifest.json')
+    with manifest_lock:
+        manifest = {'files': []}
+        try:
+            with open(manifestFile, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging('updateManifest: Error - could not read {}, starting a new one {}'.format(manifestFile, e), stdlogging.ERROR)
+        manifest['files'].append(entry)
         try:
-            os.makedirs(output_dir)
+            with open(manifestFile + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(manifestFile + '.tmp', manifestFile)
         except OSError as e:
-            logging('writeFile: Error - output directory {} does not exist, and cannot create it {}'.format(output_dir, e))
-    if os.path.exists(output_dir):
+            logging('updateManifest: Error - could not write {} {}'.format(manifestFile, e), stdlogging.ERROR)
+
+def outputDirectory(appliance=None):
+    # Everything goes straight in output_dir, or with the partitioned layout in
+    # output_dir/date=YYYY-MM-DD/hour=HH/appliance=name so readers can skip what they don't need
+    if output_layout != 'partitioned':
+        return output_dir
+    now = datetime.now()
+    return os.path.join(output_dir, now.strftime('date=%Y-%m-%d'), now.strftime('hour=%H'),
+                        'appliance=' + (appliance.name if appliance is not None else 'all'))
+
+def openOutputFile(fileName, appliance=None):
+    # Create the output directory if needed and open a new uniquely named output file,
+    # tagged with the appliance when polling more than one CMX
+    # Returns None if the file could not be created
+    kind = fileName
+    if appliance is not None:
+        fileName = appliance.fileName(fileName)
+    directory = outputDirectory(appliance)
+    logging('openOutputFile: Using {} as output directory'.format(os.path.abspath(directory)))
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            logging('openOutputFile: Error - output directory {} does not exist, and cannot create it {}'.format(directory, e), stdlogging.ERROR)
+    if os.path.exists(directory):
+        writer = getOutputWriter()
         # Create a unique file name by appending the date to the end
-        fileNameDate = fileName + datetime.strftime(datetime.now(),'-%d-%m-%y-%H-%M-%S-%f.csv')
-        fullFileName = os.path.join(output_dir, fileNameDate)
+        fileNameDate = fileName + datetime.strftime(datetime.now(),'-%d-%m-%y-%H-%M-%S-%f') + writer.extension
+        fullFileName = os.path.join(directory, fileNameDate)
         # Its a new unique file so it shouldn't exist
         if not os.path.isfile(fullFileName):
             try:
-                with open(fullFileName,'w', newline='', encoding='utf-8') as f:
-                    writer = csv.writer(f)
-                    writer.writerows(data['data'])
-                    logging('writeFile:Finished writing.')
+                return writer(fullFileName, kind if output_layout == 'partitioned' else None)
             except IOError as e:
-                logging('writeFile: Error - tried to open file for writing but something went wront {}'.format(e))
+                logging('openOutputFile: Error - tried to open file for writing but something went wront {}'.format(e), stdlogging.ERROR)
         else:
-            logging('writeFile: Error - tried to create unique output file name {} but file exists'.format(fileNameDate))
+            logging('openOutputFile: Error - tried to create unique output file name {} but file exists'.format(fileNameDate), stdlogging.ERROR)
     else:
-        logging('writeFile: Tried to create output directory and it should have worked, but there is a problem still.')
+        logging('openOutputFile: Tried to create output directory and it should have worked, but there is a problem still.')
+    return None
+
+def writeFile(data, fileName, appliance=None):
+    # Write the data to an appropriate file, returns True if the file was written
+    output = openOutputFile(fileName, appliance)
+    if output is not None:
+        try:
+            output.writerows(data['data'])
+            output.commit()
+            logging('writeFile:Finished writing.')
+            return True
+        except IOError as e:
+            logging('writeFile: Error - tried to write file but something went wront {}'.format(e), stdlogging.ERROR)
+            output.abort()
+    return False
+
+def clientKeyColumn():
+    # The first de-identified column in client_fields, which clients are told apart by, or None
+    for column, field in enumerate(client_fields):
+        if field.deidentify:
+            return column
+    return None
+
+class DeltaIndex:
+    # Remembers each client's hash with its changedOn, lastLocatedTime and coordinates from the last
+    # poll so a run can emit only the new, changed and departed clients. The index is a pickled dict
+    # keyed on the 32 byte digest of the hash so it loads and saves quickly for hundreds of thousands
+    # of clients without going back to old csv files. Every full_every runs a full snapshot is written.
+    def __init__(self, header, appliance):
+        self.indexFile = os.path.join(state_dir, appliance.fileName('client_index') + '.pickle')
+        self.header = header
+        # Clients are keyed on the first de-identified column, whatever it has been named
+        self.hashColumn = clientKeyColumn()
+        self.hashDefault = client_fields[self.hashColumn].default
+        # Columns that mean a client has changed, skip any that are not in the output
+        self.compareColumns = [header.index(name) for name in ['changedOn', 'lastLocatedTime', 'x', 'y'] if name in header]
+        self.previous = {}
+        self.runs = 0
+        self.seen = {}
+        self.counts = defaultdict(int)
+        self.load()
+        # First run, or time for a periodic resynchronisation, so write everything
+        self.full = not self.previous or self.runs % delta_full_every == 0
+
+    def load(self):
+        if os.path.isfile(self.indexFile):
+            try:
+                with open(self.indexFile, 'rb') as f:
+                    index = pickle.load(f)
+                self.previous = index['clients']
+                self.runs = index['runs']
+                logging('DeltaIndex: Loaded {:,} clients from {}'.format(len(self.previous), self.indexFile))
+            except (OSError, pickle.UnpicklingError, EOFError, KeyError) as e:
+                logging('DeltaIndex: Error - could not load {}, will write a full snapshot {}'.format(self.indexFile, e), stdlogging.ERROR)
+                self.previous = {}
+                self.runs = 0
+
+    def save(self):
+        # Only called once the run's output has been committed, so the index never gets ahead of the data
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+        tempFile = self.indexFile + '.tmp'
+        with open(tempFile, 'wb') as f:
+            pickle.dump({'runs': self.runs + 1, 'clients': self.seen}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tempFile, self.indexFile)
+        logging('DeltaIndex: Saved {:,} clients, {}'.format(len(self.seen), dict(self.counts)))
+
+    def outputHeader(self):
+        if self.full:
+            return self.header
+        return self.header + ['change']
+
+    def filterRows(self, rows):
+        # Record every row in the new index and return the rows that should be written
+        changed_rows = []
+        for row in rows:
+            if not row[self.hashColumn] or row[self.hashColumn] == self.hashDefault:
+                # No mac-address to key on, every such client would share one entry so it isn't tracked
+                self.counts['unkeyed'] += 1
+                continue
+            key = bytes.fromhex(row[self.hashColumn])
+            state = tuple(row[i] for i in self.compareColumns)
+            self.seen[key] = state
+            old_state = self.previous.get(key)
+            if old_state is None:
+                change = 'new'
+            elif old_state != state:
+                change = 'changed'
+            else:
+                self.counts['unchanged'] += 1
+                continue
+            self.counts[change] += 1
+            if not self.full:
+                changed_rows.append(row + [change])
+        if self.full:
+            return rows
+        return changed_rows
+
+    def departedRows(self):
+        # Clients in the last index that weren't seen this run. Nothing to add to a full snapshot.
+        departed = [key for key in self.previous if key not in self.seen]
+        self.counts['departed'] = len(departed)
+        if self.full:
+            return []
+        rows = []
+        for key in departed:
+            row = [''] * len(self.header) + ['departed']
+            row[self.hashColumn] = key.hex()
+            rows.append(row)
+        return rows
+
+class DeltaOutput:
+    # Sits in front of an OutputFile so getCMXData can stream through the delta index
+    def __init__(self, output, delta):
+        self.output = output
+        self.delta = delta
+
+    def writerow(self, row):
+        # Only used for the header
+        self.output.writerow(self.delta.outputHeader())
+
+    def writerows(self, rows):
+        self.output.writerows(self.delta.filterRows(rows))
+
+    def commit(self):
+        self.output.writerows(self.delta.departedRows())
+        self.output.commit()
+        self.delta.save()
+
+    def abort(self):
+        self.output.abort()
+
+def numberOrNaN(value):
+    # Missing values come through as the projection default, usually an empty string
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+def percentile(values, q):
+    # Linear interpolation between the closest ranks of sorted values, the same as numpy's default
+    position = (len(values) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+class Aggregator:
+    # Per floor, AP and band rollups of the client rows built up as pages arrive, so dashboards can
+    # read a small user_summary file instead of reloading user_data. Each row only adds to flat
+    # arrays: an integer group code per group_by column and a double per numeric column (NaN when
+    # missing). The percentiles and totals are worked out from those arrays once the poll is done,
+    # with numpy when it is installed.
+    def __init__(self, header):
+        self.groupBy = []
+        for name in aggregate_group_by:
+            # With encode_aps the AP and floor columns hold ids and have Id on the end of their name
+            column = name if name in header else name + 'Id'
+            if column in header:
+                self.groupBy.append((column, header.index(column)))
+            else:
+                logging('Aggregator: {} is not in the client columns, not grouping by it.'.format(name), stdlogging.WARNING)
+        # A column can be in both lists but only gets one array, or every page would be added to it twice
+        self.numeric = [(name, header.index(name)) for name in dict.fromkeys(aggregate_percentile_columns + aggregate_sum_columns) if name in header]
+        self.groups = {column: {} for column, index in self.groupBy}
+        self.codes = {column: array('I') for column, index in self.groupBy}
+        self.values = {name: array('d') for name, index in self.numeric}
+        self.rows = 0
+
+    def add(self, rows):
+        for column, index in self.groupBy:
+            groups = self.groups[column]
+            self.codes[column].extend(groups.setdefault(row[index], len(groups)) for row in rows)
+        for name, index in self.numeric:
+            self.values[name].extend(numberOrNaN(row[index]) for row in rows)
+        self.rows += len(rows)
+
+    def header(self):
+        header = ['groupBy', 'group', 'clients']
+        for name in aggregate_percentile_columns:
+            if name in self.values:
+                header.extend('{}_p{:g}'.format(name, q) for q in aggregate_percentiles)
+        header.extend(name + '_total' for name in aggregate_sum_columns if name in self.values)
+        return header
+
+    def rollup(self, column):
+        # The columns of the summary for one group_by column, each a list indexed by group code
+        groups = len(self.groups[column])
+        codes = self.codes[column]
+        columns = [[0] * groups]
+        for code in codes:
+            columns[0][code] += 1
+        for name in aggregate_percentile_columns:
+            if name not in self.values:
+                continue
+            grouped = [[] for group in range(groups)]
+            for code, value in zip(codes, self.values[name]):
+                if value == value:
+                    grouped[code].append(value)
+            for values in grouped:
+                values.sort()
+            for q in aggregate_percentiles:
+                columns.append([round(percentile(values, q), 2) if values else '' for values in grouped])
+        for name in aggregate_sum_columns:
+            if name not in self.values:
+                continue
+            totals = [0.0] * groups
+            for code, value in zip(codes, self.values[name]):
+                if value == value:
+                    totals[code] += value
+            columns.append([int(total) for total in totals])
+        return columns
+
+    def rollupNumpy(self, column):
+        groups = len(self.groups[column])
+        codes = numpy.frombuffer(self.codes[column], dtype=numpy.uint32)
+        columns = [numpy.bincount(codes, minlength=groups).tolist()]
+        for name in aggregate_percentile_columns:
+            if name not in self.values:
+                continue
+            values = numpy.frombuffer(self.values[name], dtype=numpy.float64)
+            present = ~numpy.isnan(values)
+            valueCodes = codes[present]
+            values = values[present]
+            # Sort by group then value so each group's values are together and in order
+            order = numpy.lexsort((values, valueCodes))
+            values = values[order]
+            counts = numpy.bincount(valueCodes, minlength=groups)
+            starts = numpy.cumsum(counts) - counts
+            # Groups with no values get an empty cell
+            present = counts > 0
+            for q in aggregate_percentiles:
+                result = numpy.zeros(groups)
+                position = (counts[present] - 1) * q / 100
+                low = numpy.floor(position).astype(numpy.int64)
+                high = numpy.minimum(low + 1, counts[present] - 1)
+                lowValues = values[starts[present] + low]
+                result[present] = lowValues + (values[starts[present] + high] - lowValues) * (position - low)
+                columns.append([round(float(value), 2) if count else '' for value, count in zip(result, counts)])
+        for name in aggregate_sum_columns:
+            if name not in self.values:
+                continue
+            values = numpy.frombuffer(self.values[name], dtype=numpy.float64)
+            totals = numpy.bincount(codes, weights=numpy.nan_to_num(values), minlength=groups)
+            columns.append([int(total) for total in totals])
+        return columns
+
+    def summary(self):
+        # The rows of the user_summary file, one per group of each group_by column
+        rows = [self.header()]
+        for column, index in self.groupBy:
+            columns = self.rollupNumpy(column) if numpy is not None else self.rollup(column)
+            for group, code in self.groups[column].items():
+                rows.append([column, group] + [values[code] for values in columns])
+        return rows
+
+class AggregateOutput:
+    # Sits in front of the streamed output so each page is added to the aggregator as it is written
+    def __init__(self, output, aggregator):
+        self.output = output
+        self.aggregator = aggregator
+
+    def writerow(self, row):
+        self.output.writerow(row)
+
+    def writerows(self, rows):
+        self.aggregator.add(rows)
+        self.output.writerows(rows)
+
+    def commit(self):
+        self.output.commit()
+
+    def abort(self):
+        self.output.abort()
+
+def pollAppliance(appliance):
+    # Poll one CMX and write its files
+    metrics = appliance.metrics = RunMetrics(appliance.name)
+    appliance.breaker.reset()
+    appliance.pages_split = 0
+    logging('pollAppliance: Using CMX: {} and username: {}'.format(appliance.host, appliance.username))
+
+    with metrics.stage('total'):
+        with metrics.stage('ap_data'):
+            ap_data = getCMXAPData(appliance)
+            if ap_data['isError']:
+                logging("getData: getCMXAPData had an error, nothing to write.")
+            elif ap_data['changed']:
+                writeFile(ap_data, 'ap_data', appliance)
+            else:
+                logging("getData: AP inventory has not changed, not writing ap_data.")
+        # In delta mode only new, changed and departed clients go in a user_delta file,
+        # apart from the periodic full snapshot
+        delta = DeltaIndex(getClientHeader(), appliance) if delta_enabled else None
+        if delta is None or delta.full:
+            userFileName = 'user_data'
+        else:
+            userFileName = 'user_delta'
+        aggregator = Aggregator(getClientHeader()) if aggregate_enabled else None
+        checkpoint = Checkpoint(appliance) if checkpoint_enabled else None
+        if streaming:
+            # Rows are written as each page arrives and the file is only committed if the whole poll worked
+            output = openOutputFile(userFileName, appliance)
+            if output is not None and delta is not None:
+                output = DeltaOutput(output, delta)
+            # The aggregator sees every client, before the delta index filters them
+            if output is not None and aggregator is not None:
+                output = AggregateOutput(output, aggregator)
+            if output is not None:
+                try:
+                    with metrics.stage('client_data'):
+                        user_data = getCMXData(appliance, output, checkpoint)
+                except Exception:
+                    output.abort()
+                    raise
+                with metrics.stage('write'):
+                    if not user_data['isError'] and delta is not None and not user_data['pages']:
+                        # Without any pages every known client would look departed
+                        logging("getData: No client pages fetched, leaving the delta index as it is.", stdlogging.WARNING)
+                        output.abort()
+                    elif not user_data['isError']:
+                        output.commit()
+                        metrics.success = True
+                        if checkpoint is not None:
+                            checkpoint.clear()
+                    else:
+                        logging("getData: getCMXData had an error, discarding streamed output.")
+                        output.abort()
+        else:
+            with metrics.stage('client_data'):
+                user_data = getCMXData(appliance, checkpoint=checkpoint)
+            with metrics.stage('write'):
+                if not user_data['isError'] and delta is not None and not user_data['pages']:
+                    logging("getData: No client pages fetched, leaving the delta index as it is.", stdlogging.WARNING)
+                elif not user_data['isError']:
+                    if aggregator is not None:
+                        aggregator.add(user_data['data'][1:])
+                    if delta is not None:
+                        rows = delta.filterRows(user_data['data'][1:])
+                        user_data['data'] = [delta.outputHeader()] + rows + delta.departedRows()
+                    metrics.success = writeFile(user_data, userFileName, appliance)
+                    if metrics.success and delta is not None:
+                        delta.save()
+                    if metrics.success and checkpoint is not None:
+                        checkpoint.clear()
+                else:
+                    logging("getData: getCMXData had an error, nothing to write.")
+        # The summary is only written alongside a complete user_data or user_delta
+        if metrics.success and aggregator is not None:
+            with metrics.stage('aggregate'):
+                writeFile({'data': aggregator.summary()}, 'user_summary', appliance)
+
+        # New APs or floors seen in the client rows need to be in the dictionaries downstream joins use
+        if encode_aps and appliance.getAPCache().dirty:
+            ap_dictionary, floor_dictionary = appliance.getAPCache().dictionaries()
+            writeFile({'data': ap_dictionary}, 'ap_dictionary', appliance)
+            writeFile({'data': floor_dictionary}, 'floor_dictionary', appliance)
+            appliance.getAPCache().save()
+
+    appliance.adaptPageSize()
+    logging('pollAppliance: Finished polling {} in {:.1f} secs.'.format(appliance.host, metrics.stages['total']))
     return
 
 def getData():
     # This is the function that gets call by the scheduler
+    # Every CMX is polled at the same time so their snapshots are taken at about the same moment
     logging('getData: Schdule woken up.')
-    logging('getData: Using CMX: {} and username: {}'.format(cmx, username))
-
-    ap_data = getCMXAPData()
-    if not ap_data['isError']:
-        writeFile(ap_data, 'ap_data')
-    else:
-        logging("getData: getCMXAPData had an error, nothing to write.")
-    user_data = getCMXData()
-    if not user_data['isError']:
-        writeFile(user_data, 'user_data')
-    else:
-        logging("getData: getCMXData had an error, nothing to write.")
+    with ThreadPoolExecutor(max_workers=len(appliances), thread_name_prefix='cmx') as executor:
+        futures = [executor.submit(pollAppliance, appliance) for appliance in appliances]
+        # One CMX failing badly shouldn't stop the others being written
+        for appliance, future in zip(appliances, futures):
+            try:
+                future.result()
+            except Exception as e:
+                logging('getData: Error - polling {} failed {}'.format(appliance.host, e), stdlogging.ERROR)
 
+    token_stats = getTokeniser().stats()
+    logging('getData: MAC token cache has {:,} entries, {:,} hits and {:,} misses so far.'.format(token_stats['size'], token_stats['hits'], token_stats['misses']))
+    if metrics_enabled:
+        try:
+            writeMetrics(appliances)
+        except OSError as e:
+            logging('getData: Error - could not write metrics to {} {}'.format(metrics_dir, e), stdlogging.ERROR)
     logging('getData: Process sleeping.')
     return
 
+# The CMX servers to poll, their files are only tagged with their name when there is more than one
+appliances = []
+if not configError:
+    try:
+        appliances = [Appliance(section, len(appliance_sections) > 1) for section in appliance_sections]
+    except (configparser.Error, ValueError) as e:
+        print("Error with config.ini, CMX settings: ", e)
+        configError = True
+
+class ScheduledRunner:
+    # Runs getData in its own thread for the daemon so a slow run never pushes back the schedule.
+    # If a run is due while the last one is still going it is skipped, or with overlap = coalesce
+    # all the runs that came due are folded into one more run as soon as the current one finishes.
+    def __init__(self, overlap):
+        self.overlap = overlap
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pending = False
+        self.stopping = False
+
+    def run(self):
+        while True:
+            try:
+                getData()
+            except Exception as e:
+                logging('ScheduledRunner: Error - run failed {}'.format(e), stdlogging.ERROR)
+            with self.lock:
+                if not self.pending or self.stopping:
+                    self.thread = None
+                    return
+                self.pending = False
+            logging('ScheduledRunner: Starting the run that came due while the last one was going.')
+
+    def due(self):
+        with self.lock:
+            if self.stopping:
+                return
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='scheduled-run')
+                self.thread.start()
+            elif self.overlap == 'coalesce':
+                self.pending = True
+                logging('ScheduledRunner: Last run still going, will run again when it finishes.', stdlogging.WARNING)
+            else:
+                logging('ScheduledRunner: Last run still going, skipping this run.', stdlogging.WARNING)
+
+    def stop(self):
+        # No more runs are started, including one that was waiting to coalesce
+        with self.lock:
+            self.stopping = True
+            self.pending = False
+
+    def join(self, timeout=None):
+        # Returns False if the run in progress is still going after timeout seconds
+        with self.lock:
+            thread = self.thread
+        if thread is not None:
+            logging('ScheduledRunner: Waiting for the run in progress to finish.')
+            thread.join(timeout)
+            return not thread.is_alive()
+        return True
+
+# The signal that asked the daemon to stop
+stop_signal = None
+
+def stopDaemon(signum, frame):
+    # Only note the signal, logging or setting stop_event here can deadlock on a lock the main thread already holds
+    global stop_signal
+    stop_signal = signum
+
+def runDaemon():
+    # Runs until SIGTERM or SIGINT, working out the next run each time rather than up front
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, stopDaemon)
+    runner = ScheduledRunner(overlap)
+    next_run = run_schedule.next(datetime.now())
+    logging('main: Process started as a daemon, running {}, first run at {}'.format(schedule_expression, next_run))
+    while stop_signal is None:
+        wait = (next_run - datetime.now()).total_seconds()
+        if wait > 0:
+            # Short sleeps so a signal or a change to the clock is noticed quickly
+            time.sleep(min(wait, 1))
+            continue
+        runner.due()
+        next_run = run_schedule.next(datetime.now())
+        logging('main: Next run at {}'.format(next_run), stdlogging.DEBUG)
+    logging('main: Got {}, no more runs will be started, giving the run in progress {}s to finish.'.format(signal.Signals(stop_signal).name, shutdown_grace), stdlogging.WARNING)
+    runner.stop()
+    # The run in progress keeps its retries so its output can still be written. Only once the
+    # grace period is up are the retries cut short, which fails any page still waiting for one.
+    if not runner.join(shutdown_grace):
+        logging('main: Run still going after {}s, stopping its retries.'.format(shutdown_grace), stdlogging.WARNING)
+        stop_event.set()
+        runner.join()
+
 def main():
     # Make sure we read in the config file ok.
     if not configError:
+        if run_schedule is not None:
+            runDaemon()
         # If we find now string in schdule we just run one straight away.
-        if 'now' in schedule:
+        elif 'now' in schedule:
             logging("main: Process started, no scheduling needed, running now.")
             getData()
         else:
@@ -0,0 +1,205 @@
+# Author Leigh Jewell
+# License https://github.com/leigh-jewell/cmx-anonymiser/blob/master/LICENSE
+# Github repository: https://github.com/leigh-jewell/cmx-anonymiser
+
+# End to end benchmark of cmx-anonymiser against the local mock CMX in cmx-mock.py.
+# For each client count it starts a mock CMX, then in a fresh python process runs a full
+# getData() poll and times each stage on its own: fetch, JSON parse, deidentifyMac,
+# row building and writeFile. Results, including peak memory, go to a JSON file so
+# they can be compared between versions.
+#
+# python cmx-benchmark.py --clients 1000,10000,100000 --output benchmark-results.json
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+
+here = os.path.dirname(os.path.abspath(__file__))
+script = os.path.join(here, 'cmx-anonymiser.py')
+mock_script = os.path.join(here, 'cmx-mock.py')
+
+config_template = """[cmx]
+cmx_ip = {address}
+url_clients = /api/location/v2/clients
+url_client_count = /api/location/v2/clients/count
+url_aps = /api/config/v1/aps
+username = benchmark
+password = benchmark
+page_size = {page_size}
+max_pages = {max_pages}
+concurrency = {concurrency}
+timeout = 30
+retry = 5
+retry_sleep = 1
+
+[output]
+output_dir = {work_dir}/output
+log_dir = {work_dir}/logs
+state_dir = {work_dir}/state
+log_console = False
+streaming = {streaming}
+
+[schedule]
+hours = now
+
+[privacy]
+salt = benchmark-salt
+"""
+
+def peakRSS():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss // 1024
+    return rss
+
+def stageResult(seconds, items, unit, **extra):
+    result = {'seconds': round(seconds, 6), unit: items, unit + '_per_sec': round(items / seconds, 1) if seconds > 0 else None}
+    result.update(extra)
+    return result
+
+def loadScript(work_dir):
+    # cmx-anonymiser.py reads config.ini from the current directory when it is loaded
+    os.chdir(work_dir)
+    spec = importlib.util.spec_from_file_location('cmx_anonymiser', script)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['cmx_anonymiser'] = module
+    spec.loader.exec_module(module)
+    return module
+
+def runScale(args):
+    # Runs in its own process so peak RSS belongs to this client count only
+    work_dir = tempfile.mkdtemp(prefix='cmx-benchmark-')
+    try:
+        max_pages = ceil(args.scale / args.page_size) + 1
+        with open(os.path.join(work_dir, 'config.ini'), 'w') as f:
+            f.write(config_template.format(address=args.address, page_size=args.page_size, max_pages=max_pages,
+                                           concurrency=args.concurrency, streaming=args.streaming, work_dir=work_dir))
+        cmx = loadScript(work_dir)
+        result = {'clients': args.scale}
+
+        # The full poll first, before the stage timings below hold everything in memory
+        start = time.perf_counter()
+        cmx.getData()
+        result['wall_seconds'] = round(time.perf_counter() - start, 6)
+        result['peak_rss_kb'] = peakRSS()
+
+        stages = {}
+        pages = ceil(args.scale / args.page_size)
+        appliance = cmx.appliances[0]
+        session = appliance.getSession()
+        def fetch(page):
+            URL = appliance.url(appliance.url_clients + '/?page={}&pageSize={}'.format(page, args.page_size))
+            return session.get(URL, timeout=appliance.timeout).content
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            bodies = list(executor.map(fetch, range(1, pages+1)))
+        stages['fetch'] = stageResult(time.perf_counter() - start, pages, 'pages', bytes=sum(len(body) for body in bodies))
+
+        start = time.perf_counter()
+        parsed = [cmx.parseJSON(body) for body in bodies]
+        stages['json_parse'] = stageResult(time.perf_counter() - start, args.scale, 'clients', backend=cmx.json_backend)
+        del bodies
+        clients = [client for page in parsed for client in page]
+        del parsed
+
+        macs = [client['macAddress'] for client in clients]
+        cmx.tokeniser = None
+        start = time.perf_counter()
+        tokens = [cmx.deidentifyMac(mac) for mac in macs]
+        stages['deidentify_mac'] = stageResult(time.perf_counter() - start, len(macs), 'macs')
+        start = time.perf_counter()
+        tokens = [cmx.deidentifyMac(mac) for mac in macs]
+        stages['deidentify_mac_cached'] = stageResult(time.perf_counter() - start, len(macs), 'macs')
+
+        start = time.perf_counter()
+        rows = [cmx.projectRecord(client, cmx.client_fields) for client in clients]
+        stages['row_building'] = stageResult(time.perf_counter() - start, len(rows), 'rows')
+        for row, token in zip(rows, tokens):
+            row[0] = token
+        del clients
+
+        start = time.perf_counter()
+        cmx.writeFile({'data': [cmx.client_header] + rows}, 'user_data')
+        stages['write_file'] = stageResult(time.perf_counter() - start, len(rows), 'rows')
+
+        result['stages'] = stages
+        result['peak_rss_kb_stages'] = peakRSS()
+        return result
+    finally:
+        os.chdir(here)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def startMock(args, clients):
+    command = [sys.executable, mock_script, '--port', '0', '--clients', str(clients),
+               '--latency', str(args.latency), '--error-rate', str(args.error_rate), '--username', 'benchmark', '--password', 'benchmark']
+    mock = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = mock.stdout.readline()
+    if not line.startswith('listening on '):
+        mock.kill()
+        raise RuntimeError('cmx-mock.py did not start: {}'.format(line))
+    return mock, line.split()[-1]
+
+def gitVersion():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=here, text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Benchmark cmx-anonymiser against a local mock CMX')
+    parser.add_argument('--clients', default='1000,10000,100000', help='comma separated client counts to run')
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--streaming', default='True', help='True or False, passed to [output] streaming')
+    parser.add_argument('--latency', type=float, default=0, help='mock CMX latency in milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of mock CMX requests that fail')
+    parser.add_argument('--output', default='benchmark-results.json', help='where to write the results')
+    # Used internally to run one client count in a child process
+    parser.add_argument('--scale', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--address', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    args = parseArgs()
+    if args.scale:
+        print(json.dumps(runScale(args)))
+        return
+    results = []
+    for clients in [int(c) for c in args.clients.split(',')]:
+        mock, address = startMock(args, clients)
+        try:
+            command = [sys.executable, os.path.abspath(__file__), '--scale', str(clients), '--address', address,
+                       '--page-size', str(args.page_size), '--concurrency', str(args.concurrency), '--streaming', args.streaming]
+            output = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+        finally:
+            mock.terminate()
+            mock.wait()
+        print('{:>9,} clients: {:.2f}s wall, peak RSS {:,} KB'.format(clients, result['wall_seconds'], result['peak_rss_kb']))
+        for name, stage in result['stages'].items():
+            print('    {:<22} {:>10.4f}s'.format(name, stage['seconds']))
+        results.append(result)
+    summary = {'version': gitVersion(),
+               'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'settings': {'page_size': args.page_size, 'concurrency': args.concurrency, 'streaming': args.streaming,
+                            'latency_ms': args.latency, 'error_rate': args.error_rate},
+               'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(summary, f, indent=2)
+    print('Results written to {}'.format(args.output))
+
+if __name__ == "__main__":
+    main()
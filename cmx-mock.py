@@ -0,0 +1,243 @@
+# Author Leigh Jewell
+# License https://github.com/leigh-jewell/cmx-anonymiser/blob/master/LICENSE
+# Github repository: https://github.com/leigh-jewell/cmx-anonymiser
+
+# A local stand in for the CMX API so cmx-anonymiser can be tested and benchmarked
+# without touching a production CMX. It answers the three APIs the script uses:
+#   url_client_count  - the number of clients
+#   url_clients       - a page of clients using page and pageSize
+#   url_aps           - the AP inventory
+# Clients are generated from their index so any page of a 1M client campus can be
+# served without holding the clients in memory, and the same page always comes back the same.
+#
+# python cmx-mock.py --clients 100000 --latency 50 --error-rate 0.01
+
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+bands = ['IEEE_802_11_B', 'IEEE_802_11_A']
+manufacturers = ['Apple', 'Samsung', 'Intel', 'Trw', 'Unknown']
+ssids = ['corp', 'guest', 'iot']
+
+def macFromIndex(prefix, index):
+    # A unique, stable mac-address for each index
+    return '{}:{:02x}:{:02x}:{:02x}'.format(prefix, (index >> 16) & 255, (index >> 8) & 255, index & 255)
+
+def apMac(index):
+    return macFromIndex('00:3a:7d', index)
+
+def floorName(settings, floor):
+    return 'Campus>Building {}>Level {}'.format(floor // 10, floor % 10)
+
+def buildClient(settings, index):
+    # Spread the values out with a cheap integer mix rather than a random generator per client
+    mix = (index * 2654435761 + settings.seed) & 0xffffffff
+    ap = mix % settings.aps
+    floor = ap % settings.floors
+    band = bands[mix % 2]
+    now = int(time.time() * 1000)
+    located = now - (mix % 60000)
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S.000+0000', time.gmtime(located / 1000))
+    return {
+        'macAddress': macFromIndex('{:02x}:{:02x}:{:02x}'.format((index >> 40) & 255, (index >> 32) & 255, (index >> 24) & 255), index),
+        'mapInfo': {
+            'mapHierarchyString': floorName(settings, floor),
+            'floorRefId': str(723413320329068650 + floor),
+            'floorDimension': {'length': 74.1, 'width': 39.0, 'height': 10.0, 'offsetX': 0, 'offsetY': 0, 'unit': 'FEET'},
+            'image': {'imageName': 'floor{}.png'.format(floor), 'zoomLevel': 4, 'width': 2048, 'height': 1024, 'size': 2048, 'maxResolution': 8, 'colorDepth': 8},
+            'tagList': []
+        },
+        'mapCoordinate': {'x': round((mix % 7410) / 100.0, 2), 'y': round((mix % 3900) / 100.0, 2), 'z': 0, 'unit': 'FEET'},
+        'currentlyTracked': True,
+        'confidenceFactor': float(16 + mix % 96),
+        'statistics': {
+            'currentServerTime': time.strftime('%Y-%m-%dT%H:%M:%S.000+0000', time.gmtime(now / 1000)),
+            'firstLocatedTime': timestamp,
+            'lastLocatedTime': timestamp,
+            'maxDetectedRssi': {
+                'apMacAddress': apMac(ap),
+                'band': band,
+                'slot': mix % 2,
+                'rssi': -30 - (mix % 60),
+                'antennaIndex': 0,
+                'lastHeardInSeconds': mix % 30
+            }
+        },
+        'historyLogReason': None,
+        'geoCoordinate': None,
+        'networkStatus': 'ACTIVE',
+        'changedOn': located,
+        'ipAddress': ['10.{}.{}.{}'.format((index >> 16) & 255, (index >> 8) & 255, index & 255)],
+        'userName': 'user{}'.format(index),
+        'ssId': ssids[mix % len(ssids)],
+        'sourceTimestamp': None,
+        'band': band,
+        'apMacAddress': apMac(ap),
+        'dot11Status': 'ASSOCIATED',
+        'manufacturer': manufacturers[mix % len(manufacturers)],
+        'areaGlobalIdList': [floor, 1],
+        'detectingControllers': '10.0.0.{}'.format(1 + ap % 4),
+        'bytesSent': mix % 10000000,
+        'bytesReceived': (mix >> 3) % 10000000
+    }
+
+def buildAP(settings, index):
+    floor = index % settings.floors
+    interfaces = [{'band': 'IEEE_802_11_B', 'slotNumber': 0, 'channelNumber': 1 + 5 * (index % 3), 'txPowerLevel': 1 + index % 5, 'antennaPattern': 'Internal', 'antennaAngle': 1.57, 'antennaElevAngle': 0, 'antennaGain': 4}]
+    # Every fifth AP only has the one radio
+    if index % 5 != 0:
+        interfaces.append({'band': 'IEEE_802_11_A', 'slotNumber': 1, 'channelNumber': 36 + 4 * (index % 8), 'txPowerLevel': 1 + index % 7, 'antennaPattern': 'Internal', 'antennaAngle': 1.57, 'antennaElevAngle': 0, 'antennaGain': 4})
+    return {
+        'radioMacAddress': apMac(index),
+        'name': 'AP-{}'.format(index),
+        'mapCoordinates': {'x': round((index * 37 % 7410) / 100.0, 2), 'y': round((index * 53 % 3900) / 100.0, 2), 'z': 0, 'unit': 'FEET'},
+        'apInterfaces': interfaces,
+        'floorIdString': str(723413320329068650 + floor)
+    }
+
+class MockCMXHandler(BaseHTTPRequestHandler):
+    # Keep connections alive so the client's session pooling is exercised
+    protocol_version = 'HTTP/1.1'
+    settings = None
+    etag = None
+
+    def log_message(self, format, *args):
+        if self.settings.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def sendJSON(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def sendEmpty(self, status, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def authorised(self):
+        if not self.settings.username:
+            return True
+        expected = 'Basic ' + base64.b64encode('{}:{}'.format(self.settings.username, self.settings.password).encode()).decode()
+        return self.headers.get('Authorization') == expected
+
+    def failPage(self, page):
+        # Pages given with --fail-pages fail --fail-count times, or every time if it is 0
+        settings = self.settings
+        if page not in settings.fail_pages:
+            return False
+        with settings.lock:
+            settings.failures[page] = settings.failures.get(page, 0) + 1
+            return settings.fail_count == 0 or settings.failures[page] <= settings.fail_count
+
+    def do_GET(self):
+        settings = self.settings
+        if settings.latency > 0:
+            time.sleep(settings.latency / 1000.0)
+        if not self.authorised():
+            self.sendEmpty(401, {'WWW-Authenticate': 'Basic realm="cmx"'})
+            return
+        if settings.error_rate > 0 and random.random() < settings.error_rate:
+            # Mix of throttling and hard errors like a busy CMX
+            if random.random() < 0.5:
+                self.sendEmpty(503, {'Retry-After': '1'})
+            else:
+                self.sendEmpty(500)
+            return
+        url = urlparse(self.path)
+        path = url.path.rstrip('/')
+        query = parse_qs(url.query)
+        if path.endswith('/clients/count'):
+            self.sendJSON(200, {'count': settings.count if settings.count is not None else settings.clients})
+        elif path.endswith('/clients'):
+            page = int(query.get('page', ['1'])[0])
+            page_size = int(query.get('pageSize', ['1000'])[0])
+            if self.failPage(page):
+                self.sendEmpty(500)
+                return
+            start = (page - 1) * page_size
+            end = min(start + page_size, settings.clients)
+            # Big pages take longer, like a loaded CMX
+            if settings.latency_per_client > 0:
+                time.sleep(max(end - start, 0) * settings.latency_per_client / 1000.0)
+            self.sendJSON(200, [buildClient(settings, i) for i in range(start, end)])
+        elif path.endswith('/aps'):
+            if self.headers.get('If-None-Match') == self.etag:
+                self.sendEmpty(304, {'ETag': self.etag})
+            else:
+                self.sendJSON(200, [buildAP(settings, i) for i in range(settings.aps)], {'ETag': self.etag})
+        else:
+            self.sendEmpty(404)
+
+class MockCMX:
+    # The server running in a background thread, for use from other scripts
+    def __init__(self, settings):
+        handler = type('Handler', (MockCMXHandler,), {'settings': settings})
+        handler.etag = '"aps-{}-{}"'.format(settings.aps, settings.seed)
+        self.server = ThreadingHTTPServer((settings.host, settings.port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return '{}:{}'.format(host, port)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Local mock of the CMX APIs used by cmx-anonymiser')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080, help='0 picks a free port')
+    parser.add_argument('--clients', type=int, default=1000, help='number of clients to report')
+    parser.add_argument('--count', type=int, help='client count to report, like a CMX whose count is out of date')
+    parser.add_argument('--aps', type=int, default=50, help='number of APs in the inventory')
+    parser.add_argument('--floors', type=int, default=10, help='number of floors the APs are spread over')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds to wait before each response')
+    parser.add_argument('--latency-per-client', type=float, default=0, help='extra milliseconds per client in a page')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests that fail with 500 or 503')
+    parser.add_argument('--fail-pages', default='', help='comma separated client pages that fail with 500')
+    parser.add_argument('--fail-count', type=int, default=0, help='how many times each of --fail-pages fails, 0 for always')
+    parser.add_argument('--seed', type=int, default=0, help='changes the generated values')
+    parser.add_argument('--username', default='', help='require basic auth with this username')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    settings = parser.parse_args(argv)
+    settings.aps = max(settings.aps, 1)
+    settings.floors = max(settings.floors, 1)
+    settings.fail_pages = set(int(page) for page in settings.fail_pages.split(',') if page.strip())
+    settings.failures = {}
+    settings.lock = threading.Lock()
+    return settings
+
+def main():
+    settings = parseArgs()
+    mock = MockCMX(settings)
+    # The first line tells whoever started us which address to use, useful with --port 0
+    print('listening on {}'.format(mock.address()), flush=True)
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    mock.server.server_close()
+
+if __name__ == "__main__":
+    main()